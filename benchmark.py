@@ -0,0 +1,396 @@
+"""Offline load benchmark for the bot's message handlers.
+
+Drives the real handle_text, search_music, my_stats and admin_stats handlers
+with synthetic updates. Yandex Music is replaced by a local fake with
+configurable latency, Telegram by fake messages, and the database by an
+in-memory stand-in (or a real Postgres with --database-url).
+
+    python benchmark.py --messages 2000 --concurrency 32 --latency-ms 80 --output bench.json
+    python benchmark.py --output new.json --compare bench.json
+    python benchmark.py --compare bench.json --against new.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime
+from types import SimpleNamespace
+
+ADMIN_ID = 1
+FIRST_USER_ID = 1000
+
+# Canned rows for the in-memory database, first matching fragment wins
+FAKE_RESULTS = [
+    ('SELECT (SELECT COUNT(*) FROM users)', [(1000, 50000, 80000, 300, 200000, 20000)]),
+    ('FROM stats_daily', [(500, 2000)]),
+    ('LEFT JOIN LATERAL', [
+        (FIRST_USER_ID + i, f'user{i}', f'User {i}', 500 - i, 300 - i,
+         datetime(2024, 5, 1, 12, 0), 'поиск (текст)', 'query', f'query {i}')
+        for i in range(10)
+    ]),
+    ('FROM query_stats', [(f'query {i}', 1000 - i * 50) for i in range(10)]),
+    ('FROM artist_stats', [(f'Artist {i}', 5000 - i * 300) for i in range(5)]),
+    ('FROM admins', []),
+    ('total_uses, total_searches, created_at', [('bench', 'Bench', 120, 80, datetime(2024, 1, 1))]),
+    ('SELECT q.canonical, v.count', [(f'query {i}', 20 - i) for i in range(5)]),
+    ('COUNT(*) FROM track_views', [(400,)]),
+    ('JOIN track_artists', [(f'Artist {i}', 40 - i) for i in range(3)]),
+]
+
+class FakeCursor:
+    """Cursor stand-in that answers from FAKE_RESULTS and records statement counts"""
+    
+    def __init__(self, connection, metric):
+        self.connection = connection
+        self._metric = metric
+        self._rows = []
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def close(self):
+        pass
+    
+    def mogrify(self, query, vars=None):
+        # execute_values joins mogrified rows; the fake never parses them
+        return query if isinstance(query, bytes) else query.encode()
+    
+    def execute(self, query, vars=None):
+        if isinstance(query, bytes):
+            query = query.decode('utf-8', 'replace')
+        statement = query.split(None, 1)[0] if query.strip() else ''
+        self._metric.labels(statement.upper()).observe(0)
+        self._rows = next((list(rows) for fragment, rows in FAKE_RESULTS if fragment in query), [])
+    
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+    
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+    
+    def copy_expert(self, sql, file):
+        pass
+
+class FakeConnection:
+    encoding = 'UTF8'
+    
+    def __init__(self, metric):
+        self.closed = 0
+        self.autocommit = False
+        self._metric = metric
+    
+    def cursor(self, *args, **kwargs):
+        return FakeCursor(self, self._metric)
+    
+    def commit(self):
+        pass
+    
+    def rollback(self):
+        pass
+    
+    def close(self):
+        self.closed = 1
+
+class FakePool:
+    """Stand-in for ThreadedConnectionPool.
+    
+    Returned connections are reused like the real pool does, so the bot's
+    health-check pings only hit new or idle connections and do not inflate
+    the per-message statement count.
+    """
+    
+    def __init__(self, metric):
+        self._metric = metric
+        self._idle = []
+        self._lock = threading.Lock()
+    
+    def getconn(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return FakeConnection(self._metric)
+    
+    def putconn(self, conn, close=False):
+        if close:
+            conn.close()
+            return
+        with self._lock:
+            self._idle.append(conn)
+    
+    def closeall(self):
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle.clear()
+
+class FakeYandexClient:
+    """Local search backend with the same shape as ClientAsync.search()"""
+    
+    def __init__(self, latency, jitter, page_size, total, seed):
+        self.latency = latency
+        self.jitter = jitter
+        self.page_size = page_size
+        self.total = total
+        self.calls = 0
+        self._random = random.Random(seed)
+    
+    async def search(self, text, type_='track', page=0):
+        self.calls += 1
+        await asyncio.sleep(max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter)))
+        start = page * self.page_size
+        tracks = [
+            SimpleNamespace(
+                id=str(zlib.crc32(f'{text}:{n}'.encode())),
+                albums=[SimpleNamespace(id=n)],
+                title=f'{text} track {n}',
+                artists=[SimpleNamespace(id=n % 17 + 1, name=f'Artist {n % 17}')],
+                duration_ms=180000 + n * 1000
+            )
+            for n in range(start, min(start + self.page_size, self.total))
+        ]
+        return SimpleNamespace(tracks=SimpleNamespace(results=tracks, total=self.total))
+
+class FakeMessage:
+    def __init__(self, user, text, send_latency):
+        self.from_user = user
+        self.chat_id = user.id
+        self.chat = SimpleNamespace(id=user.id)
+        self.text = text
+        self.replies = 0
+        self._send_latency = send_latency
+    
+    async def reply_text(self, text, **kwargs):
+        self.replies += 1
+        if self._send_latency:
+            await asyncio.sleep(self._send_latency)
+        return self
+
+class FakeUpdate:
+    def __init__(self, message):
+        self.message = message
+        self.effective_user = message.from_user
+        self.effective_chat = message.chat
+        self.callback_query = None
+        self.inline_query = None
+
+def parse_mix(value):
+    """'handle_text=70,search_music=20' -> [('handle_text', 70.0), ...]"""
+    mix = []
+    for part in value.split(','):
+        name, weight = part.split('=')
+        mix.append((name.strip(), float(weight)))
+    return mix
+
+def build_workload(args):
+    """Deterministic list of (handler name, user id, message text, context args)"""
+    rng = random.Random(args.seed)
+    names, weights = zip(*parse_mix(args.mix))
+    # Zipf-like popularity, so the search cache sees realistic repeats
+    queries = [f'artist {i} song' for i in range(args.distinct_queries)]
+    query_weights = [1 / (rank + 1) for rank in range(len(queries))]
+    
+    workload = []
+    for handler in rng.choices(names, weights, k=args.messages):
+        user_id = FIRST_USER_ID + rng.randrange(args.users)
+        query = rng.choices(queries, query_weights)[0]
+        if handler == 'handle_text':
+            workload.append((handler, user_id, query, []))
+        elif handler == 'search_music':
+            workload.append((handler, user_id, f'/search {query}', query.split()))
+        elif handler == 'my_stats':
+            workload.append((handler, user_id, '/my_stats', []))
+        elif handler == 'admin_stats':
+            workload.append((handler, ADMIN_ID, '/admin_stats', []))
+        else:
+            raise SystemExit(f'Unknown handler in --mix: {handler}')
+    return workload
+
+def load_bot(args):
+    """Import main.py with benchmark-friendly settings"""
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    os.environ['ADMIN_USER_ID'] = str(ADMIN_ID)
+    if not args.rate_limit:
+        os.environ['RATE_LIMIT_PER_MINUTE'] = '1e9'
+        os.environ['RATE_LIMIT_BURST'] = '1e9'
+    import main
+    logging.getLogger().setLevel(logging.WARNING)
+    return main
+
+def count_db_statements(metric):
+    counts = {}
+    for family in metric.collect():
+        for sample in family.samples:
+            if sample.name.endswith('_count'):
+                counts[sample.labels['statement']] = int(sample.value)
+    return counts
+
+def percentiles(values):
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None, 'max': None}
+    ordered = sorted(values)
+    
+    def rank(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 2)
+    
+    return {'p50': rank(0.50), 'p95': rank(0.95), 'p99': rank(0.99), 'max': round(ordered[-1] * 1000, 2)}
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def run_benchmark(args):
+    bot = load_bot(args)
+    backend = FakeYandexClient(
+        args.latency_ms / 1000, args.jitter_ms / 1000, args.page_size, args.total_results, args.seed
+    )
+    bot.yandex_client = backend
+    if args.database_url:
+        bot.init_db()
+    else:
+        bot.db_pool = FakePool(bot.DB_STATEMENT_DURATION)
+    bot.start_analytics_writer()
+    # Skip the background warm-up, everything it would set up is in place
+    bot.bot_ready.set()
+    
+    handlers = {
+        name: bot.instrument(name, getattr(bot, name))
+        for name in ('handle_text', 'search_music', 'my_stats', 'admin_stats')
+    }
+    processor = bot.ChatOrderedUpdateProcessor(args.concurrency)
+    await processor.initialize()
+    workload = build_workload(args)
+    latencies = {name: [] for name in handlers}
+    
+    async def timed(name, update, context):
+        started = time.perf_counter()
+        await handlers[name](update, context)
+        latencies[name].append(time.perf_counter() - started)
+    
+    async def dispatch(name, user_id, text, context_args):
+        user = SimpleNamespace(id=user_id, username=f'user{user_id}', first_name='Bench', last_name=None)
+        update = FakeUpdate(FakeMessage(user, text, args.send_latency_ms / 1000))
+        context = SimpleNamespace(args=context_args)
+        await processor.process_update(update, timed(name, update, context))
+    
+    statements_before = count_db_statements(bot.DB_STATEMENT_DURATION)
+    started = time.perf_counter()
+    await asyncio.gather(*(dispatch(*item) for item in workload))
+    elapsed = time.perf_counter() - started
+    
+    # Drain the write-behind queue so its statements are part of the count
+    await asyncio.to_thread(bot.stop_analytics_writer)
+    await processor.shutdown()
+    statements_after = count_db_statements(bot.DB_STATEMENT_DURATION)
+    statements = {
+        label: count - statements_before.get(label, 0)
+        for label, count in statements_after.items()
+        if count - statements_before.get(label, 0)
+    }
+    bot.close_db_pool()
+    
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'against')},
+        'database': 'postgres' if args.database_url else 'in-memory',
+        'messages': len(workload),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_msgs_per_s': round(len(workload) / elapsed, 1),
+        'latency_ms': dict(
+            {'all': percentiles(all_latencies)},
+            **{name: percentiles(values) for name, values in latencies.items() if values}
+        ),
+        'db_statements_per_message': round(sum(statements.values()) / len(workload), 3),
+        'db_statements': statements,
+        'upstream_calls': backend.calls,
+        'search_cache': dict(bot.search_cache.stats),
+        'analytics': bot.get_analytics_queue_stats(),
+    }
+
+def print_report(result):
+    print(f"Commit {result['commit']} - {result['messages']} messages, {result['database']} database")
+    print(f"Throughput: {result['throughput_msgs_per_s']} msg/s ({result['elapsed_s']} s)")
+    for name, stats in result['latency_ms'].items():
+        print(f"  {name:<13} p50 {stats['p50']} ms  p95 {stats['p95']} ms  p99 {stats['p99']} ms")
+    print(f"DB statements per message: {result['db_statements_per_message']} {result['db_statements']}")
+    print(f"Upstream calls: {result['upstream_calls']}, search cache: {result['search_cache']}")
+
+def compare(baseline, current, max_regression):
+    """Print the change of the headline numbers, return False on a regression"""
+    checks = [
+        ('throughput msg/s', baseline['throughput_msgs_per_s'], current['throughput_msgs_per_s'], True),
+        ('p50 ms', baseline['latency_ms']['all']['p50'], current['latency_ms']['all']['p50'], False),
+        ('p95 ms', baseline['latency_ms']['all']['p95'], current['latency_ms']['all']['p95'], False),
+        ('p99 ms', baseline['latency_ms']['all']['p99'], current['latency_ms']['all']['p99'], False),
+        ('db statements/msg', baseline['db_statements_per_message'], current['db_statements_per_message'], False),
+    ]
+    print(f"Comparing {baseline.get('commit')} -> {current.get('commit')}")
+    ok = True
+    for label, before, after, higher_is_better in checks:
+        if not before:
+            print(f'  {label:<18} {before} -> {after}')
+            continue
+        change = (after - before) / before * 100
+        regressed = -change > max_regression if higher_is_better else change > max_regression
+        ok = ok and not regressed
+        print(f"  {label:<18} {before} -> {after} ({change:+.1f}%){'  REGRESSION' if regressed else ''}")
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load benchmark for the bot handlers')
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32, help='updates processed at once')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--distinct-queries', type=int, default=300)
+    parser.add_argument('--mix', default='handle_text=70,search_music=20,my_stats=8,admin_stats=2')
+    parser.add_argument('--latency-ms', type=float, default=80, help='fake Yandex search latency')
+    parser.add_argument('--jitter-ms', type=float, default=20)
+    parser.add_argument('--send-latency-ms', type=float, default=0, help='fake Telegram reply latency')
+    parser.add_argument('--page-size', type=int, default=20)
+    parser.add_argument('--total-results', type=int, default=60)
+    parser.add_argument('--rate-limit', action='store_true', help='keep the per-user search rate limit')
+    parser.add_argument('--database-url', default=os.getenv('BENCH_DATABASE_URL'),
+                        help='benchmark against this Postgres instead of the in-memory stand-in')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--compare', help='baseline results JSON to compare against')
+    parser.add_argument('--against', help='compare this results JSON instead of running the benchmark')
+    parser.add_argument('--max-regression', type=float, default=10, help='allowed regression, percent')
+    args = parser.parse_args()
+    
+    if args.against:
+        with open(args.against, encoding='utf-8') as f:
+            result = json.load(f)
+    else:
+        result = asyncio.run(run_benchmark(args))
+        print_report(result)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+    
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if not compare(baseline, result, args.max_regression):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -2,16 +2,38 @@ import os
 import logging
 import threading
 import time
-import requests
-from aiohttp import web
+# Taken before the heavier imports below, for the startup timings
+PROCESS_STARTED = time.monotonic()
+import queue
+import sys
+import hashlib
+import unicodedata
+import signal
+import gzip
+import re
+import io
+import contextvars
+import cProfile
+import pstats
+from aiohttp import web, ClientSession, ClientTimeout
 import asyncio
-import psycopg2
 import json
-from datetime import datetime
+import zlib
+import secrets
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import wraps
 import pytz
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from yandex_music import Client
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
+)
+from telegram.ext import (
+    Application, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, InlineQueryHandler, MessageHandler,
+    filters, ContextTypes
+)
+from telegram.request import HTTPXRequest
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 
 # Moscow timezone
 MSK = pytz.timezone('Europe/Moscow')
@@ -22,172 +44,690 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Prometheus metrics, served on /metrics
+HANDLER_DURATION = Histogram('bot_handler_duration_seconds', 'Time spent handling an update', ['handler'])
+HANDLER_CALLS = Counter('bot_handler_calls_total', 'Updates handled per command/handler', ['handler'])
+HANDLERS_IN_FLIGHT = Gauge('bot_handlers_in_flight', 'Updates being handled right now', ['handler'])
+UPSTREAM_SEARCH_DURATION = Histogram(
+    'bot_upstream_search_duration_seconds', 'Yandex Music search call duration', ['outcome']
+)
+DB_STATEMENT_DURATION = Histogram('bot_db_statement_duration_seconds', 'Postgres statement duration', ['statement'])
+SEARCH_CACHE_LOOKUPS = Counter('bot_search_cache_lookups_total', 'Search cache lookups', ['result'])
+SEARCHES_REJECTED = Counter('bot_searches_rejected_total', 'Searches rejected by rate or concurrency limits', ['reason'])
+
+# Wall time per phase of the update being handled: 'upstream', 'db' and 'send'.
+# The rest of the handler time is reported as 'render'
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', '1000'))
+_request_phases = contextvars.ContextVar('request_phases', default=None)
+
+def record_phase(phase, seconds):
+    # asyncio.to_thread copies the context, so DB work in worker threads is counted too
+    phases = _request_phases.get()
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
 yandex_client = None
-db_connection = None
 
-def get_db_connection():
+# Database connection pool settings
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+DB_HEALTH_CHECK_INTERVAL = float(os.getenv('DB_HEALTH_CHECK_INTERVAL', '30'))
+
+# psycopg2 and yandex_music are imported where they are first used, so the bot
+# starts taking updates without waiting for them
+
+_timed_cursor_class = None
+
+def get_timed_cursor_class():
+    """Cursor class that records every statement's duration in DB_STATEMENT_DURATION"""
+    global _timed_cursor_class
+    if _timed_cursor_class is None:
+        import psycopg2.extensions
+        
+        class TimedCursor(psycopg2.extensions.cursor):
+            def execute(self, query, vars=None):
+                started = time.perf_counter()
+                try:
+                    return super().execute(query, vars)
+                finally:
+                    elapsed = time.perf_counter() - started
+                    statement = query.split(None, 1)[0] if query.strip() else ''
+                    if isinstance(statement, bytes):
+                        statement = statement.decode('ascii', 'replace')
+                    DB_STATEMENT_DURATION.labels(statement.upper()).observe(elapsed)
+                    record_phase('db', elapsed)
+        
+        _timed_cursor_class = TimedCursor
+    return _timed_cursor_class
+
+db_pool = None
+_db_pool_lock = threading.Lock()
+# ThreadedConnectionPool raises instead of waiting when it is exhausted,
+# so callers queue on this semaphore first
+_db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+_db_last_used = {}
+
+def get_db_pool():
+    """Create the shared connection pool on first use"""
+    global db_pool
+    if db_pool is None:
+        with _db_pool_lock:
+            if db_pool is None:
+                from psycopg2 import pool as pg_pool
+                db_pool = pg_pool.ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX, os.getenv('DATABASE_URL'), cursor_factory=get_timed_cursor_class()
+                )
+                logger.info(f'Database pool created (min={DB_POOL_MIN}, max={DB_POOL_MAX})')
+    return db_pool
+
+def close_db_pool():
+    global db_pool
+    with _db_pool_lock:
+        if db_pool is not None:
+            db_pool.closeall()
+            db_pool = None
+            _db_last_used.clear()
+            logger.info('Database pool closed')
+
+def _connection_is_healthy(conn):
+    """Ping connections that have been idle longer than DB_HEALTH_CHECK_INTERVAL"""
+    import psycopg2
+    if conn.closed:
+        return False
+    last_used = _db_last_used.get(id(conn))
+    if last_used is not None and time.monotonic() - last_used < DB_HEALTH_CHECK_INTERVAL:
+        return True
     try:
-        conn = psycopg2.connect(os.getenv('DATABASE_URL'))
-        return conn
-    except Exception as e:
-        logger.error(f'Database connection error: {e}')
-        return None
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
 
-def log_user(user_id, username, first_name, last_name):
+def _release_connection(pool, conn):
+    if conn.closed:
+        _db_last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+    else:
+        _db_last_used[id(conn)] = time.monotonic()
+        pool.putconn(conn)
+
+@contextmanager
+def db_connection():
+    """Check out a pooled connection, commit on success and roll back on error"""
+    import psycopg2
+    from psycopg2 import pool as pg_pool
+    if not _db_pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise pg_pool.PoolError('Timed out waiting for a database connection')
     try:
-        conn = get_db_connection()
-        if not conn:
-            return
-        cur = conn.cursor()
-        cur.execute(
-            'INSERT INTO users (user_id, username, first_name, last_name, total_uses) VALUES (%s, %s, %s, %s, 1) '
-            'ON CONFLICT (user_id) DO UPDATE SET total_uses = users.total_uses + 1',
-            (user_id, username, first_name, last_name)
-        )
-        conn.commit()
-        cur.close()
-        conn.close()
-    except Exception as e:
-        logger.error(f'Error logging user: {e}')
+        pool = get_db_pool()
+        conn = pool.getconn()
+        if not _connection_is_healthy(conn):
+            logger.warning('Discarding broken database connection')
+            _db_last_used.pop(id(conn), None)
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    conn.close()
+            raise
+        finally:
+            _release_connection(pool, conn)
+    finally:
+        _db_pool_slots.release()
 
-def log_search(user_id, query, results_count):
+# Analytics write-behind queue settings
+ANALYTICS_QUEUE_SIZE = int(os.getenv('ANALYTICS_QUEUE_SIZE', '10000'))
+ANALYTICS_BATCH_SIZE = int(os.getenv('ANALYTICS_BATCH_SIZE', '500'))
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv('ANALYTICS_FLUSH_INTERVAL', '1'))
+
+analytics_queue = queue.Queue(maxsize=ANALYTICS_QUEUE_SIZE)
+analytics_stats = {'enqueued': 0, 'dropped': 0, 'written': 0, 'failed': 0, 'batches': 0}
+_analytics_stats_lock = threading.Lock()
+_analytics_stop = threading.Event()
+_analytics_thread = None
+
+def _count_analytics(key, amount=1):
+    with _analytics_stats_lock:
+        analytics_stats[key] += amount
+
+def enqueue_analytics(kind, row):
+    """Queue an analytics event; drops it if the queue is full"""
     try:
-        conn = get_db_connection()
-        if not conn:
-            return
-        cur = conn.cursor()
-        cur.execute(
-            'UPDATE users SET total_searches = total_searches + 1 WHERE user_id = %s',
-            (user_id,)
-        )
-        cur.execute(
-            'INSERT INTO searches (user_id, query, results_count) VALUES (%s, %s, %s)',
-            (user_id, query, results_count)
-        )
-        conn.commit()
-        cur.close()
-        conn.close()
-    except Exception as e:
-        logger.error(f'Error logging search: {e}')
+        analytics_queue.put_nowait((kind, row))
+        _count_analytics('enqueued')
+    except queue.Full:
+        _count_analytics('dropped')
+        logger.warning(f'Analytics queue is full, dropped {kind} event')
+
+Gauge('bot_analytics_queue_depth', 'Analytics events waiting to be written').set_function(analytics_queue.qsize)
+Gauge('bot_analytics_events_dropped', 'Analytics events dropped since start').set_function(
+    lambda: analytics_stats['dropped'] + analytics_stats['failed']
+)
+
+def get_analytics_queue_stats():
+    with _analytics_stats_lock:
+        stats = dict(analytics_stats)
+    stats['depth'] = analytics_queue.qsize()
+    return stats
+
+def log_user(user_id, username, first_name, last_name):
+    enqueue_analytics('user', (user_id, username, first_name, last_name))
+
+def log_search(user_id, query, query_key, results_count):
+    """query_key is the (query id, canonical text) pair from canonical_query()"""
+    enqueue_analytics('search', (user_id, query, query_key, results_count, datetime.now(pytz.UTC)))
 
 def log_action(user_id, action_type, action_details=None):
     """Log user action to user_actions table"""
+    enqueue_analytics('action', (user_id, action_type, action_details, datetime.now(pytz.UTC)))
+
+def log_track_views(user_id, tracks, query_key):
+    """Log the compact tracks shown for one search as a single event"""
+    if tracks:
+        enqueue_analytics('track_views', (user_id, tracks, query_key, datetime.now(pytz.UTC)))
+
+# Ids the writer thread knows to exist in the database, so they are not upserted again:
+# Yandex track id -> tracks.id, query id -> canonical text, and user ids
+_catalog_track_ids = OrderedDict()
+_known_query_ids = OrderedDict()
+_known_user_ids = OrderedDict()
+WRITER_ID_CACHE_MAX_ENTRIES = 50000
+
+def parse_artist_id(artist_id):
+    # Compilations and some user uploads come without a numeric artist id
     try:
-        conn = get_db_connection()
-        if not conn:
-            return
-        cur = conn.cursor()
-        cur.execute(
-            'INSERT INTO user_actions (user_id, action_type, action_details) VALUES (%s, %s, %s)',
-            (user_id, action_type, action_details)
+        return int(artist_id)
+    except (TypeError, ValueError):
+        return None
+
+def upsert_catalog(cur, tracks):
+    """Add unseen tracks and their artists to the catalog.
+    
+    Takes {yandex id: compact track}, returns {yandex id: tracks.id} for the tracks that were
+    not cached yet. The caller caches them once the transaction has committed.
+    """
+    from psycopg2.extras import execute_values
+    new_tracks = {yandex_id: track for yandex_id, track in tracks.items() if yandex_id not in _catalog_track_ids}
+    if not new_tracks:
+        return {}
+    
+    artists = {}
+    for track in new_tracks.values():
+        for artist_id, name in zip(track.get('artist_ids', []), track['artists']):
+            artist_id = parse_artist_id(artist_id)
+            if artist_id is not None:
+                artists[artist_id] = name
+    if artists:
+        execute_values(
+            cur,
+            'INSERT INTO artists (id, name) VALUES %s ON CONFLICT (id) DO NOTHING',
+            sorted(artists.items()),
+            page_size=ANALYTICS_BATCH_SIZE
         )
-        conn.commit()
-        cur.close()
-        conn.close()
-    except Exception as e:
-        logger.error(f'Error logging action: {e}')
+    
+    # DO UPDATE instead of DO NOTHING so that existing tracks also return their id
+    rows = execute_values(
+        cur,
+        'INSERT INTO tracks (yandex_id, album_id, title, duration_ms) VALUES %s '
+        'ON CONFLICT (yandex_id) DO UPDATE SET title = EXCLUDED.title RETURNING yandex_id, id',
+        sorted(
+            (yandex_id, track['album_id'], track['title'] or '', track['duration_ms'])
+            for yandex_id, track in new_tracks.items()
+        ),
+        page_size=ANALYTICS_BATCH_SIZE,
+        fetch=True
+    )
+    track_ids = dict(rows)
+    
+    track_artists = set()
+    for yandex_id, track in new_tracks.items():
+        for position, artist_id in enumerate(track.get('artist_ids', [])):
+            artist_id = parse_artist_id(artist_id)
+            if artist_id is not None and yandex_id in track_ids:
+                track_artists.add((track_ids[yandex_id], artist_id, position))
+    if track_artists:
+        execute_values(
+            cur,
+            'INSERT INTO track_artists (track_id, artist_id, position) VALUES %s ON CONFLICT DO NOTHING',
+            sorted(track_artists),
+            page_size=ANALYTICS_BATCH_SIZE
+        )
+    return track_ids
 
-def log_track_view(user_id, track_title, track_artists, query):
-    try:
-        conn = get_db_connection()
-        if not conn:
-            return
-        cur = conn.cursor()
-        cur.execute(
-            'INSERT INTO track_views (user_id, track_title, track_artists, query) VALUES (%s, %s, %s, %s)',
-            (user_id, track_title, track_artists, query)
+def upsert_queries(cur, queries):
+    """Add unseen canonical queries ({query id: canonical text}), return the ones written"""
+    from psycopg2.extras import execute_values
+    new_queries = {query_id: text for query_id, text in queries.items() if query_id not in _known_query_ids}
+    if new_queries:
+        execute_values(
+            cur,
+            'INSERT INTO queries (id, canonical) VALUES %s ON CONFLICT (id) DO NOTHING',
+            sorted(new_queries.items()),
+            page_size=ANALYTICS_BATCH_SIZE
         )
-        conn.commit()
-        cur.close()
-        conn.close()
-    except Exception as e:
-        logger.error(f'Error logging track view: {e}')
+    return new_queries
 
-def init_db():
-    """Initialize database tables if they don't exist"""
-    try:
-        conn = get_db_connection()
-        if not conn:
-            logger.error('Failed to connect to database for initialization')
-            return False
-        cur = conn.cursor()
-        
-        # Create users table
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                username VARCHAR(255),
-                first_name VARCHAR(255),
-                last_name VARCHAR(255),
-                total_uses INT DEFAULT 0,
-                total_searches INT DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+def ensure_users(cur, user_ids):
+    """Add a bare users row for ids that have events but were never logged with log_user()"""
+    from psycopg2.extras import execute_values
+    new_user_ids = {user_id: True for user_id in user_ids if user_id not in _known_user_ids}
+    if new_user_ids:
+        execute_values(
+            cur,
+            'INSERT INTO users (user_id) VALUES %s ON CONFLICT (user_id) DO NOTHING',
+            [(user_id,) for user_id in sorted(new_user_ids)],
+            page_size=ANALYTICS_BATCH_SIZE
+        )
+    return new_user_ids
+
+def remember_ids(cache, ids):
+    """Add committed ids to one of the writer's bounded id caches"""
+    for key, value in ids.items():
+        cache[key] = value
+        cache.move_to_end(key)
+    while len(cache) > WRITER_ID_CACHE_MAX_ENTRIES:
+        cache.popitem(last=False)
+
+def write_analytics_batch(events):
+    """Write a batch of queued events in one transaction using multi-row statements"""
+    from psycopg2.extras import execute_values
+    users = {}
+    search_counts = {}
+    searches = []
+    actions = []
+    track_views = []
+    catalog = {}
+    queries = {}
+    cache_rows = {}
+    
+    for kind, row in events:
+        if kind == 'user':
+            user_id = row[0]
+            if user_id in users:
+                users[user_id][4] += 1
+            else:
+                users[user_id] = [*row, 1]
+        elif kind == 'search':
+            user_id, query, (query_id, canonical), results_count, created_at = row
+            search_counts[user_id] = search_counts.get(user_id, 0) + 1
+            queries[query_id] = canonical
+            searches.append((user_id, query, query_id, results_count, created_at))
+        elif kind == 'action':
+            actions.append(row)
+        elif kind == 'track_views':
+            user_id, shown_tracks, (query_id, canonical), created_at = row
+            queries[query_id] = canonical
+            for track in shown_tracks:
+                catalog[str(track['id'])] = track
+                track_views.append((user_id, track, query_id, created_at))
+        elif kind == 'cache_put':
+            # Only the newest result per key is worth writing
+            cache_rows[(row[0], row[1])] = row
+    
+    with db_connection() as conn, conn.cursor() as cur:
+        # Users and queries go first so that the other rows satisfy their foreign keys
+        new_queries = upsert_queries(cur, queries)
+        if users:
+            execute_values(
+                cur,
+                'INSERT INTO users (user_id, username, first_name, last_name, total_uses) VALUES %s '
+                'ON CONFLICT (user_id) DO UPDATE SET total_uses = users.total_uses + EXCLUDED.total_uses',
+                sorted(users.values()),
+                page_size=ANALYTICS_BATCH_SIZE
             )
-        ''')
-        
-        # Create searches table
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS searches (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT REFERENCES users(user_id),
-                query TEXT,
-                results_count INT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        # Some handlers log actions for users that were never logged with log_user()
+        referenced_user_ids = {row[0] for row in searches} | {row[0] for row in actions} | {row[0] for row in track_views}
+        new_user_ids = ensure_users(cur, referenced_user_ids - users.keys())
+        if search_counts:
+            execute_values(
+                cur,
+                'UPDATE users SET total_searches = users.total_searches + v.n '
+                'FROM (VALUES %s) AS v(user_id, n) WHERE users.user_id = v.user_id',
+                sorted(search_counts.items()),
+                page_size=ANALYTICS_BATCH_SIZE
             )
-        ''')
-        
-        # Create track_views table
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS track_views (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT REFERENCES users(user_id),
-                track_title TEXT,
-                track_artists TEXT,
-                query TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            execute_values(
+                cur,
+                'INSERT INTO searches (user_id, query, query_id, results_count, created_at) VALUES %s',
+                searches,
+                page_size=ANALYTICS_BATCH_SIZE
             )
-        ''')
-        
-        # Create user_actions table
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS user_actions (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT REFERENCES users(user_id),
-                action_type VARCHAR(255),
-                action_details TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        if actions:
+            execute_values(
+                cur,
+                'INSERT INTO user_actions (user_id, action_type, action_details, created_at) VALUES %s',
+                actions,
+                page_size=ANALYTICS_BATCH_SIZE
             )
-        ''')
-        
-        # Create admins table
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS admins (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT REFERENCES users(user_id),
-                added_by BIGINT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        if track_views:
+            new_track_ids = upsert_catalog(cur, catalog)
+            execute_values(
+                cur,
+                'INSERT INTO track_views (user_id, track_id, query_id, created_at) VALUES %s',
+                [
+                    (
+                        user_id,
+                        new_track_ids.get(str(track['id']), _catalog_track_ids.get(str(track['id']))),
+                        query_id,
+                        created_at
+                    )
+                    for user_id, track, query_id, created_at in track_views
+                ],
+                page_size=ANALYTICS_BATCH_SIZE
             )
-        ''')
-        
-        # Create bot_sessions table
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS bot_sessions (
-                id SERIAL PRIMARY KEY,
-                started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        if cache_rows:
+            execute_values(
+                cur,
+                'INSERT INTO search_cache (query_id, page, payload, expires_at) VALUES %s '
+                'ON CONFLICT (query_id, page) DO UPDATE SET payload = EXCLUDED.payload, expires_at = EXCLUDED.expires_at',
+                [
+                    (query_id, page, pack_search_result(result), expires_at)
+                    for (query_id, page), (_, _, result, expires_at) in sorted(cache_rows.items())
+                ],
+                page_size=ANALYTICS_BATCH_SIZE
             )
-        ''')
-        
-        # Create indexes
-        cur.execute('CREATE INDEX IF NOT EXISTS idx_searches_user_id ON searches(user_id)')
-        cur.execute('CREATE INDEX IF NOT EXISTS idx_track_views_user_id ON track_views(user_id)')
-        cur.execute('CREATE INDEX IF NOT EXISTS idx_user_actions_user_id ON user_actions(user_id)')
-        cur.execute('CREATE INDEX IF NOT EXISTS idx_admins_user_id ON admins(user_id)')
-        
-        conn.commit()
-        cur.close()
-        conn.close()
-        logger.info('Database tables initialized successfully')
-        print('✅ Таблицы БД инициализированы!')
+        update_stats_rollups(cur, searches, track_views)
+    
+    remember_ids(_known_user_ids, dict.fromkeys(users, True))
+    remember_ids(_known_user_ids, new_user_ids)
+    remember_ids(_known_query_ids, new_queries)
+    if track_views and new_track_ids:
+        remember_ids(_catalog_track_ids, new_track_ids)
+
+def update_stats_rollups(cur, searches, track_views):
+    """Add a batch of searches and track views to the /admin_stats rollup tables"""
+    from psycopg2.extras import execute_values
+    daily = {}
+    query_counts = {}
+    artist_counts = {}
+    
+    for user_id, query, query_id, results_count, created_at in searches:
+        day = daily.setdefault(created_at.date(), [0, 0])
+        day[0] += 1
+        query_counts[query_id] = query_counts.get(query_id, 0) + 1
+    
+    for user_id, track, query_id, created_at in track_views:
+        day = daily.setdefault(created_at.date(), [0, 0])
+        day[1] += 1
+        # Every artist of a multi-artist track gets the view
+        for artist_id in set(filter(None, map(parse_artist_id, track.get('artist_ids', [])))):
+            artist_counts[artist_id] = artist_counts.get(artist_id, 0) + 1
+    
+    # Rows are sorted so concurrent writers lock rollup rows in the same order
+    if daily:
+        execute_values(
+            cur,
+            'INSERT INTO stats_daily (day, searches, track_views) VALUES %s '
+            'ON CONFLICT (day) DO UPDATE SET searches = stats_daily.searches + EXCLUDED.searches, '
+            'track_views = stats_daily.track_views + EXCLUDED.track_views',
+            sorted((day, counts[0], counts[1]) for day, counts in daily.items()),
+            page_size=ANALYTICS_BATCH_SIZE
+        )
+    if query_counts:
+        execute_values(
+            cur,
+            'INSERT INTO query_stats (query_id, searches) VALUES %s '
+            'ON CONFLICT (query_id) DO UPDATE SET searches = query_stats.searches + EXCLUDED.searches',
+            sorted(query_counts.items()),
+            page_size=ANALYTICS_BATCH_SIZE
+        )
+    if artist_counts:
+        execute_values(
+            cur,
+            'INSERT INTO artist_stats (artist_id, views) VALUES %s '
+            'ON CONFLICT (artist_id) DO UPDATE SET views = artist_stats.views + EXCLUDED.views',
+            sorted(artist_counts.items()),
+            page_size=ANALYTICS_BATCH_SIZE
+        )
+
+def rebuild_stats_rollups():
+    """Rebuild the rollup tables from the raw searches and track_views history"""
+    with db_connection() as conn, conn.cursor() as cur:
+        # TRUNCATE locks the rollups, so batches written meanwhile are applied after the rebuild
+        cur.execute('TRUNCATE stats_daily, query_stats, artist_stats')
+        cur.execute("""
+            INSERT INTO stats_daily (day, searches, track_views)
+            SELECT day, SUM(searches), SUM(track_views)
+            FROM (
+                SELECT created_at::date AS day, COUNT(*) AS searches, 0 AS track_views
+                FROM searches
+                GROUP BY 1
+                UNION ALL
+                SELECT created_at::date AS day, 0 AS searches, COUNT(*) AS track_views
+                FROM track_views
+                GROUP BY 1
+            ) counts
+            GROUP BY day
+        """)
+        cur.execute("""
+            INSERT INTO query_stats (query_id, searches)
+            SELECT query_id, COUNT(*)
+            FROM searches
+            WHERE query_id IS NOT NULL
+            GROUP BY query_id
+        """)
+        cur.execute("""
+            INSERT INTO artist_stats (artist_id, views)
+            SELECT ta.artist_id, COUNT(*)
+            FROM track_views tv
+            JOIN track_artists ta ON ta.track_id = tv.track_id
+            GROUP BY ta.artist_id
+        """)
+
+QUERY_BACKFILL_PAGE_SIZE = 1000
+
+def backfill_query_ids():
+    """Fill query_id on searches and track_views rows written before canonical query ids.
+    
+    Canonicalization happens in Python, so each table's distinct query texts are
+    read once, hashed and loaded into a temp table. One UPDATE per partition then
+    joins against it and commits, so no table is scanned more than twice and no
+    single transaction spans a whole table. Returns the number of rows updated.
+    """
+    from psycopg2.extras import execute_values
+    updated = 0
+    with db_connection() as conn, conn.cursor() as cur:
+        # IF NOT EXISTS: a connection left with the table by an earlier failure still works
+        cur.execute('CREATE TEMP TABLE IF NOT EXISTS query_backfill (query TEXT PRIMARY KEY, query_id BIGINT NOT NULL)')
+        try:
+            for table in ('searches', 'track_views'):
+                cur.execute(f'SELECT DISTINCT query FROM {table} WHERE query_id IS NULL AND query IS NOT NULL')
+                query_keys = {text: canonical_query(text) for text, in cur.fetchall()}
+                if not query_keys:
+                    continue
+                
+                cur.execute('TRUNCATE query_backfill')
+                execute_values(
+                    cur,
+                    'INSERT INTO queries (id, canonical) VALUES %s ON CONFLICT (id) DO NOTHING',
+                    sorted(set(query_keys.values())),
+                    page_size=QUERY_BACKFILL_PAGE_SIZE
+                )
+                execute_values(
+                    cur,
+                    'INSERT INTO query_backfill (query, query_id) VALUES %s',
+                    [(text, query_id) for text, (query_id, _) in query_keys.items()],
+                    page_size=QUERY_BACKFILL_PAGE_SIZE
+                )
+                cur.execute('ANALYZE query_backfill')
+                conn.commit()
+                
+                cur.execute("""
+                    SELECT c.relname
+                    FROM pg_inherits i
+                    JOIN pg_class c ON c.oid = i.inhrelid
+                    WHERE i.inhparent = %s::regclass
+                    ORDER BY c.relname
+                """, (table,))
+                # Names come from the catalog, so they are safe to interpolate
+                for partition in [row[0] for row in cur.fetchall()] or [table]:
+                    cur.execute(f"""
+                        UPDATE {partition} t
+                        SET query_id = b.query_id
+                        FROM query_backfill b
+                        WHERE t.query = b.query AND t.query_id IS NULL
+                    """)
+                    updated += cur.rowcount
+                    conn.commit()
+        finally:
+            # The temp table would otherwise stay on the pooled connection. The drop is
+            # committed here because db_connection() rolls back when an error propagates
+            if not conn.closed:
+                conn.rollback()
+                cur.execute('DROP TABLE IF EXISTS query_backfill')
+                conn.commit()
+    return updated
+
+def _collect_analytics_batch():
+    """Wait for the first event, then gather more until the size or time threshold"""
+    try:
+        batch = [analytics_queue.get(timeout=ANALYTICS_FLUSH_INTERVAL)]
+    except queue.Empty:
+        return []
+    
+    deadline = time.monotonic() + ANALYTICS_FLUSH_INTERVAL
+    while len(batch) < ANALYTICS_BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 and not _analytics_stop.is_set():
+            break
+        try:
+            batch.append(analytics_queue.get(timeout=max(remaining, 0)))
+        except queue.Empty:
+            break
+    return batch
+
+def analytics_writer():
+    logger.info('Analytics writer thread started')
+    while not (_analytics_stop.is_set() and analytics_queue.empty()):
+        batch = _collect_analytics_batch()
+        if not batch:
+            continue
+        try:
+            write_analytics_batch(batch)
+            _count_analytics('written', len(batch))
+            _count_analytics('batches')
+        except Exception as e:
+            logger.error(f'Error writing analytics batch of {len(batch)} events, retrying one by one: {e}')
+            write_analytics_events_singly(batch)
+    logger.info('Analytics writer thread stopped')
+
+def write_analytics_events_singly(events):
+    """Fallback for a failed batch: write each event in its own transaction.
+    
+    One bad event then costs only itself. A connection-level error fails the
+    rest of the batch right away instead of retrying against a dead database.
+    """
+    import psycopg2
+    from psycopg2 import pool as pg_pool
+    for index, event in enumerate(events):
+        try:
+            write_analytics_batch([event])
+            _count_analytics('written')
+        except (psycopg2.OperationalError, psycopg2.InterfaceError, pg_pool.PoolError) as e:
+            _count_analytics('failed', len(events) - index)
+            logger.error(f'Database unavailable, dropped {len(events) - index} analytics events: {e}')
+            return
+        except Exception as e:
+            _count_analytics('failed')
+            logger.error(f'Error writing {event[0]} analytics event: {e}')
+    _count_analytics('batches')
+
+def start_analytics_writer():
+    global _analytics_thread
+    _analytics_stop.clear()
+    _analytics_thread = threading.Thread(target=analytics_writer, daemon=True)
+    _analytics_thread.start()
+
+def stop_analytics_writer(timeout=30):
+    """Drain the queue and stop the writer thread"""
+    _analytics_stop.set()
+    if _analytics_thread:
+        _analytics_thread.join(timeout)
+    stats = get_analytics_queue_stats()
+    logger.info(f'Analytics writer stopped: {stats}')
+
+# Schema migrations: migrations/NNNN_name.sql, applied in order and recorded in schema_version
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATIONS_LOCK_ID = 7270001
+NO_TRANSACTION_MARKER = '-- migrate: no-transaction'
+
+def list_migrations():
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        if not filename.endswith('.sql'):
+            continue
+        version = int(filename.split('_', 1)[0])
+        with open(os.path.join(MIGRATIONS_DIR, filename), encoding='utf-8') as f:
+            migrations.append((version, filename, f.read()))
+    return migrations
+
+def split_sql_statements(sql):
+    """Split a plain migration into statements (no function bodies or DO blocks)"""
+    lines = [line for line in sql.splitlines() if not line.strip().startswith('--')]
+    return [statement.strip() for statement in '\n'.join(lines).split(';') if statement.strip()]
+
+def apply_migration(cur, version, name, sql):
+    logger.info(f'Applying migration {name}')
+    if sql.startswith(NO_TRANSACTION_MARKER):
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+        for statement in split_sql_statements(sql):
+            cur.execute(statement)
+        cur.execute('INSERT INTO schema_version (version, name) VALUES (%s, %s)', (version, name))
+        return
+    
+    cur.execute('BEGIN')
+    try:
+        cur.execute(sql)
+        cur.execute('INSERT INTO schema_version (version, name) VALUES (%s, %s)', (version, name))
+        cur.execute('COMMIT')
+    except Exception:
+        cur.execute('ROLLBACK')
+        raise
+
+def init_db():
+    """Apply pending schema migrations"""
+    try:
+        with db_connection() as conn:
+            conn.autocommit = True
+            try:
+                with conn.cursor() as cur:
+                    # Several instances may start at once; only one of them migrates
+                    cur.execute('SELECT pg_advisory_lock(%s)', (MIGRATIONS_LOCK_ID,))
+                    try:
+                        cur.execute("SELECT to_regclass('schema_version')")
+                        if cur.fetchone()[0] is None:
+                            cur.execute("""
+                                CREATE TABLE schema_version (
+                                    version INT PRIMARY KEY,
+                                    name TEXT NOT NULL,
+                                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                                )
+                            """)
+                        cur.execute('SELECT version FROM schema_version')
+                        applied_versions = set(row[0] for row in cur.fetchall())
+                        
+                        pending = [m for m in list_migrations() if m[0] not in applied_versions]
+                        for version, name, sql in pending:
+                            apply_migration(cur, version, name, sql)
+                    finally:
+                        cur.execute('SELECT pg_advisory_unlock(%s)', (MIGRATIONS_LOCK_ID,))
+            finally:
+                conn.autocommit = False
+        
+        if pending:
+            logger.info(f'Applied {len(pending)} database migration(s)')
+            print(f'✅ Применено миграций БД: {len(pending)}')
+        else:
+            logger.info('Database schema is up to date')
         return True
     except Exception as e:
         logger.error(f'Error initializing database: {e}')
@@ -196,23 +736,582 @@ def init_db():
 
 def log_bot_startup():
     try:
-        conn = get_db_connection()
-        if not conn:
-            return
-        cur = conn.cursor()
-        # Get current UTC time from Python and store as ISO string
-        utc_now = datetime.now(pytz.UTC)
-        cur.execute(
-            "INSERT INTO bot_sessions (started_at) VALUES (%s)",
-            (utc_now,)
-        )
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db_connection() as conn, conn.cursor() as cur:
+            # Get current UTC time from Python and store as ISO string
+            utc_now = datetime.now(pytz.UTC)
+            cur.execute(
+                "INSERT INTO bot_sessions (started_at) VALUES (%s)",
+                (utc_now,)
+            )
         logger.info('Bot startup logged to database')
     except Exception as e:
         logger.error(f'Error logging bot startup: {e}')
 
+# Partition maintenance for the monthly partitioned analytics tables (migration 0004)
+PARTITIONED_TABLES = ('searches', 'track_views', 'user_actions')
+PARTITION_NAME_RE = re.compile(r'^(%s)_p(\d{4})_(\d{2})$' % '|'.join(PARTITIONED_TABLES))
+PARTITIONS_AHEAD = int(os.getenv('ANALYTICS_PARTITIONS_AHEAD', '3'))
+# Months of history kept in the database; 0 keeps everything
+ANALYTICS_RETENTION_MONTHS = int(os.getenv('ANALYTICS_RETENTION_MONTHS', '0'))
+ANALYTICS_ARCHIVE_DIR = os.getenv(
+    'ANALYTICS_ARCHIVE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive')
+)
+PARTITION_MAINTENANCE_INTERVAL = float(os.getenv('PARTITION_MAINTENANCE_INTERVAL', '21600'))
+PARTITION_MAINTENANCE_LOCK_ID = 7270002
+
+def add_months(day, months):
+    """First day of the month `months` away from the month containing `day`"""
+    month_index = day.year * 12 + day.month - 1 + months
+    return day.replace(year=month_index // 12, month=month_index % 12 + 1, day=1)
+
+def ensure_partitions(cur):
+    """Create the current and upcoming monthly partitions, return how many were added"""
+    this_month = datetime.now(pytz.UTC).date().replace(day=1)
+    created = 0
+    for table in PARTITIONED_TABLES:
+        for offset in range(PARTITIONS_AHEAD + 1):
+            cur.execute('SELECT ensure_monthly_partition(%s, %s)', (table, add_months(this_month, offset)))
+            created += cur.fetchone()[0]
+    return created
+
+def archive_partition(cur, partition):
+    """Dump a detached partition to ANALYTICS_ARCHIVE_DIR/<partition>.csv.gz"""
+    os.makedirs(ANALYTICS_ARCHIVE_DIR, exist_ok=True)
+    path = os.path.join(ANALYTICS_ARCHIVE_DIR, f'{partition}.csv.gz')
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wb') as f:
+        # The name matched PARTITION_NAME_RE, so it is safe to interpolate
+        cur.copy_expert(f'COPY {partition} TO STDOUT WITH (FORMAT csv, HEADER)', f)
+    os.replace(tmp_path, path)
+    return path
+
+def archive_expired_partitions(cur):
+    """Detach, archive and drop the monthly partitions older than the retention window.
+    
+    Each step commits on its own, so a partition left detached by a failed run
+    is still found by name and finished on the next one.
+    """
+    cutoff = add_months(datetime.now(pytz.UTC).date().replace(day=1), -ANALYTICS_RETENTION_MONTHS)
+    cur.execute("""
+        SELECT relname, relispartition
+        FROM pg_class
+        WHERE relkind = 'r' AND relnamespace = current_schema()::regnamespace
+    """)
+    archived = []
+    for partition, attached in sorted(cur.fetchall()):
+        match = PARTITION_NAME_RE.match(partition)
+        if not match:
+            continue
+        table, year, month = match.group(1), int(match.group(2)), int(match.group(3))
+        if add_months(datetime(year, month, 1).date(), 1) > cutoff:
+            continue
+        
+        if attached:
+            cur.execute(f'ALTER TABLE {table} DETACH PARTITION {partition}')
+        path = archive_partition(cur, partition)
+        cur.execute(f'DROP TABLE {partition}')
+        logger.info(f'Archived partition {partition} to {path}')
+        archived.append(partition)
+    return archived
+
+def maintain_partitions():
+    """Create upcoming analytics partitions and apply the retention policy"""
+    created, archived = 0, []
+    try:
+        with db_connection() as conn:
+            conn.autocommit = True
+            try:
+                with conn.cursor() as cur:
+                    # Only one instance does the maintenance at a time
+                    cur.execute('SELECT pg_try_advisory_lock(%s)', (PARTITION_MAINTENANCE_LOCK_ID,))
+                    if not cur.fetchone()[0]:
+                        return created, archived
+                    try:
+                        created = ensure_partitions(cur)
+                        if ANALYTICS_RETENTION_MONTHS > 0:
+                            archived = archive_expired_partitions(cur)
+                    finally:
+                        cur.execute('SELECT pg_advisory_unlock(%s)', (PARTITION_MAINTENANCE_LOCK_ID,))
+            finally:
+                conn.autocommit = False
+        if created or archived:
+            logger.info(f'Partition maintenance: {created} created, {len(archived)} archived')
+    except Exception as e:
+        logger.error(f'Error maintaining partitions: {e}')
+    return created, archived
+
+async def partition_maintenance():
+    while True:
+        await asyncio.to_thread(maintain_partitions)
+        await asyncio.sleep(PARTITION_MAINTENANCE_INTERVAL)
+
+async def init_yandex_client(token):
+    """Create the async Yandex Music client used by the search handlers"""
+    global yandex_client
+    try:
+        from yandex_music import ClientAsync
+        yandex_client = await ClientAsync(token).init()
+        logger.info('Яндекс.Музыка подключена успешно!')
+        print('✅ Яндекс.Музыка подключена!')
+    except Exception as e:
+        logger.error(f'Ошибка подключения к Яндекс.Музыке: {e}')
+        print(f'⚠️ Не удалось подключиться к Яндекс.Музыке: {e}')
+
+# Search cache settings
+SEARCH_CACHE_TTL = float(os.getenv('SEARCH_CACHE_TTL', '600'))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv('SEARCH_CACHE_MAX_ENTRIES', '1000'))
+SEARCH_CACHE_MAX_BYTES = int(os.getenv('SEARCH_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+# Second-level cache in the search_cache table; a TTL of 0 turns it off
+SEARCH_CACHE_L2_TTL = float(os.getenv('SEARCH_CACHE_L2_TTL', '3600'))
+SEARCH_CACHE_L2_TIMEOUT = float(os.getenv('SEARCH_CACHE_L2_TIMEOUT', '0.5'))
+SEARCH_CACHE_PURGE_INTERVAL = float(os.getenv('SEARCH_CACHE_PURGE_INTERVAL', '3600'))
+
+def approx_size(value):
+    """Rough memory footprint of plain dict/list/str values in bytes"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(approx_size(k) + approx_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(approx_size(item) for item in value)
+    return size
+
+class TTLCache:
+    """LRU cache with per-entry TTL, bounded by entry count and approximate memory"""
+    
+    def __init__(self, ttl, max_entries, max_bytes=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+        self._entries = OrderedDict()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats['misses'] += 1
+            return None
+        expires_at, _, value = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.stats['expirations'] += 1
+            self.stats['misses'] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats['hits'] += 1
+        return value
+    
+    def set(self, key, value, ttl=None):
+        if key in self._entries:
+            self._remove(key)
+        size = approx_size(key) + approx_size(value)
+        if self.max_bytes and size > self.max_bytes:
+            return
+        expires_at = time.monotonic() + (ttl if ttl is not None else self.ttl)
+        self._entries[key] = (expires_at, size, value)
+        self.size_bytes += size
+        while len(self._entries) > self.max_entries or (self.max_bytes and self.size_bytes > self.max_bytes):
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.stats['evictions'] += 1
+    
+    def ttl_left(self, key):
+        """Seconds until the entry expires (None if absent or expired), without touching counters"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        seconds_left = entry[0] - time.monotonic()
+        return seconds_left if seconds_left > 0 else None
+    
+    def peek(self, key):
+        """Return a live value without touching LRU order or counters"""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[2]
+    
+    def pop(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._remove(key)
+        return entry[2]
+    
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.size_bytes -= size
+
+search_cache = TTLCache(SEARCH_CACHE_TTL, SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_MAX_BYTES)
+Gauge('bot_search_cache_entries', 'Entries in the search cache').set_function(lambda: len(search_cache))
+
+_QUERY_SEPARATORS_RE = re.compile(r'[\W_]+')
+
+def canonicalize_query(text):
+    """Canonical form of a query: NFKC, case-folded, ё as е, punctuation and whitespace collapsed"""
+    text = unicodedata.normalize('NFKC', text).casefold().replace('ё', 'е')
+    canonical = ' '.join(_QUERY_SEPARATORS_RE.sub(' ', text).split())
+    # A query made only of punctuation keeps it rather than collapsing to ''
+    return canonical or ' '.join(text.split())
+
+def query_id_for(canonical):
+    """Signed 64-bit id of a canonical query: the first 8 bytes of its MD5"""
+    return int.from_bytes(hashlib.md5(canonical.encode('utf-8')).digest()[:8], 'big', signed=True)
+
+def canonical_query(text):
+    """(query id, canonical text) for a raw query; handlers compute it once per message"""
+    canonical = canonicalize_query(text)
+    return query_id_for(canonical), canonical
+
+def compact_track(track):
+    """Keep only the fields the bot renders, instead of the full Track object"""
+    return {
+        'id': track.id,
+        'album_id': track.albums[0].id if track.albums else None,
+        'title': track.title,
+        'artists': [artist.name for artist in track.artists],
+        'artist_ids': [artist.id for artist in track.artists],
+        'duration_ms': track.duration_ms
+    }
+
+# Upstream protection settings
+UPSTREAM_CONCURRENCY = int(os.getenv('UPSTREAM_CONCURRENCY', '8'))
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv('UPSTREAM_QUEUE_TIMEOUT', '5'))
+RATE_LIMIT_PER_MINUTE = float(os.getenv('RATE_LIMIT_PER_MINUTE', '20'))
+RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST', '5'))
+RATE_LIMIT_MAX_USERS = int(os.getenv('RATE_LIMIT_MAX_USERS', '10000'))
+
+upstream_semaphore = asyncio.Semaphore(UPSTREAM_CONCURRENCY)
+
+class UpstreamBusyError(Exception):
+    """All upstream slots stayed busy for UPSTREAM_QUEUE_TIMEOUT seconds"""
+
+# Per-user token buckets: user_id -> (tokens, last update), least recently used first
+_rate_buckets = OrderedDict()
+
+def allow_search(user_id):
+    """Take a token from the user's bucket; returns False when the user is over the limit"""
+    now = time.monotonic()
+    refill_rate = RATE_LIMIT_PER_MINUTE / 60
+    
+    bucket = _rate_buckets.pop(user_id, None)
+    if bucket is None:
+        tokens = RATE_LIMIT_BURST
+    else:
+        tokens = min(RATE_LIMIT_BURST, bucket[0] + (now - bucket[1]) * refill_rate)
+    
+    allowed = tokens >= 1
+    if allowed:
+        tokens -= 1
+    _rate_buckets[user_id] = (tokens, now)
+    
+    # A bucket idle long enough to be full again is the same as no bucket
+    full_refill_time = RATE_LIMIT_BURST / refill_rate
+    while _rate_buckets:
+        oldest_tokens, oldest_updated = next(iter(_rate_buckets.values()))
+        if len(_rate_buckets) > RATE_LIMIT_MAX_USERS or now - oldest_updated > full_refill_time:
+            _rate_buckets.popitem(last=False)
+        else:
+            break
+    
+    if not allowed:
+        SEARCHES_REJECTED.labels('user_rate').inc()
+    return allowed
+
+# Upstream searches currently in flight, keyed by normalized query
+_inflight_searches = {}
+
+def pack_search_result(result):
+    return zlib.compress(json.dumps(result, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+def unpack_search_result(payload):
+    return json.loads(zlib.decompress(bytes(payload)))
+
+def read_search_cache_row(key):
+    """Return (result, seconds left) for a live L2 entry, or None"""
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT payload, EXTRACT(EPOCH FROM expires_at - now())
+            FROM search_cache
+            WHERE query_id = %s AND page = %s AND expires_at > now()
+        """, key)
+        row = cur.fetchone()
+    if row is None:
+        return None
+    return unpack_search_result(row[0]), float(row[1])
+
+async def load_search_l2(key):
+    """Fill an in-memory miss from the search_cache table"""
+    if not SEARCH_CACHE_L2_TTL or not bot_ready.is_set():
+        return None
+    try:
+        row = await asyncio.wait_for(asyncio.to_thread(read_search_cache_row, key), SEARCH_CACHE_L2_TIMEOUT)
+    except Exception as e:
+        # A slow or unavailable database must not hold up the search
+        logger.warning(f'Search L2 cache read failed: {e or type(e).__name__}')
+        row = None
+    if row is None:
+        SEARCH_CACHE_LOOKUPS.labels('l2_miss').inc()
+        return None
+    
+    SEARCH_CACHE_LOOKUPS.labels('l2_hit').inc()
+    result, seconds_left = row
+    search_cache.set(key, result, ttl=min(SEARCH_CACHE_TTL, seconds_left))
+    return result
+
+def store_search_l2(key, result):
+    # Serialized and written by the analytics writer thread, off the event loop
+    if SEARCH_CACHE_L2_TTL:
+        expires_at = datetime.now(pytz.UTC) + timedelta(seconds=SEARCH_CACHE_L2_TTL)
+        enqueue_analytics('cache_put', (key[0], key[1], result, expires_at))
+
+def purge_search_cache():
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute('DELETE FROM search_cache WHERE expires_at <= now()')
+        return cur.rowcount
+
+async def search_cache_purger():
+    while True:
+        await asyncio.sleep(SEARCH_CACHE_PURGE_INTERVAL)
+        try:
+            purged = await asyncio.to_thread(purge_search_cache)
+            if purged:
+                logger.info(f'Purged {purged} expired search cache rows')
+        except Exception as e:
+            logger.error(f'Error purging search cache: {e}')
+
+async def search_upstream(query, key):
+    # Wait for a free upstream slot only briefly, so overload is reported instead of queued
+    try:
+        await asyncio.wait_for(upstream_semaphore.acquire(), UPSTREAM_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        SEARCHES_REJECTED.labels('upstream_busy').inc()
+        raise UpstreamBusyError('Yandex Music search is overloaded')
+    
+    started = time.perf_counter()
+    try:
+        search_result = await yandex_client.search(query, type_='track', page=key[1])
+    except Exception:
+        UPSTREAM_SEARCH_DURATION.labels('error').observe(time.perf_counter() - started)
+        raise
+    finally:
+        upstream_semaphore.release()
+    UPSTREAM_SEARCH_DURATION.labels('ok').observe(time.perf_counter() - started)
+    
+    if search_result and search_result.tracks:
+        tracks = [compact_track(track) for track in search_result.tracks.results]
+        result = {'tracks': tracks, 'total': search_result.tracks.total or len(tracks)}
+    else:
+        result = {'tracks': [], 'total': 0}
+    search_cache.set(key, result)
+    store_search_l2(key, result)
+    return result
+
+def shared_fetch(key, fetch):
+    """Return the in-flight fetch for key, starting fetch() if there is none.
+    
+    Concurrent requests for the same query share one upstream call.
+    """
+    task = _inflight_searches.get(key)
+    if task is None:
+        task = asyncio.ensure_future(fetch())
+        _inflight_searches[key] = task
+        
+        def forget(finished_task):
+            if _inflight_searches.get(key) is finished_task:
+                del _inflight_searches[key]
+        
+        task.add_done_callback(forget)
+    return task
+
+async def search_tracks(query, page=0, query_key=None):
+    """Search one upstream results page through the in-memory and L2 caches.
+    
+    The cache key is the canonical query id; query_key is canonical_query(query)
+    when the caller already has it. Returns {'tracks': [compact track records],
+    'total': total number of matches}.
+    """
+    if query_key is None:
+        query_key = canonical_query(query)
+    key = (query_key[0], page)
+    result = search_cache.get(key)
+    if result is not None:
+        SEARCH_CACHE_LOOKUPS.labels('hit').inc()
+        return result
+    SEARCH_CACHE_LOOKUPS.labels('miss').inc()
+    
+    # The L2 read stays outside the 'upstream' timing below; its statements count as 'db'.
+    # A query already being fetched upstream skips it and joins that call
+    if key not in _inflight_searches:
+        result = await load_search_l2(key)
+        if result is not None:
+            return result
+    task = shared_fetch(key, lambda: search_upstream(query, key))
+    
+    # shield() keeps one cancelled waiter from cancelling the call for everyone else
+    started = time.perf_counter()
+    try:
+        return await asyncio.shield(task)
+    finally:
+        record_phase('upstream', time.perf_counter() - started)
+
+# Prewarmer: keeps the first results page of the most searched recent queries in the cache
+PREWARM_TOP_QUERIES = int(os.getenv('PREWARM_TOP_QUERIES', '100'))
+PREWARM_WINDOW_HOURS = float(os.getenv('PREWARM_WINDOW_HOURS', '24'))
+PREWARM_CALLS_PER_MINUTE = float(os.getenv('PREWARM_CALLS_PER_MINUTE', '30'))
+PREWARM_INTERVAL = float(os.getenv('PREWARM_INTERVAL', '60'))
+PREWARM_LIST_REFRESH = float(os.getenv('PREWARM_LIST_REFRESH', '600'))
+# Entries with less time left than this are refreshed; keep it above PREWARM_INTERVAL
+PREWARM_REFRESH_AHEAD = float(os.getenv('PREWARM_REFRESH_AHEAD', '180'))
+PREWARM_REFRESHES = Counter('bot_search_prewarm_total', 'Search cache entries refreshed by the prewarmer', ['source'])
+
+def load_popular_queries():
+    """Most searched canonical queries of the last PREWARM_WINDOW_HOURS as [(cache key, query)]"""
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT q.id, q.canonical
+            FROM (
+                SELECT query_id, COUNT(*) AS searches
+                FROM searches
+                WHERE created_at >= (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') - %s * INTERVAL '1 hour'
+                  AND query_id IS NOT NULL
+                GROUP BY query_id
+                ORDER BY searches DESC
+                LIMIT %s
+            ) s
+            JOIN queries q ON q.id = s.query_id
+            ORDER BY s.searches DESC
+        """, (PREWARM_WINDOW_HOURS, PREWARM_TOP_QUERIES))
+        return [((query_id, 0), canonical) for query_id, canonical in cur.fetchall()]
+
+async def prewarm_round(popular, call_spacing):
+    """Refresh the popular queries whose cache entries are missing or about to expire"""
+    for key, query in popular:
+        seconds_left = search_cache.ttl_left(key)
+        if seconds_left is not None and seconds_left > PREWARM_REFRESH_AHEAD:
+            continue
+        if seconds_left is None and await load_search_l2(key) is not None:
+            # ttl_left() is None if the cache rejected the entry as too large
+            if (search_cache.ttl_left(key) or 0) > PREWARM_REFRESH_AHEAD:
+                PREWARM_REFRESHES.labels('l2').inc()
+                continue
+        # Users come first: skip the rest of the round while upstream slots are taken
+        if upstream_semaphore.locked() or not yandex_client:
+            break
+        
+        try:
+            await shared_fetch(key, lambda: search_upstream(query, key))
+            PREWARM_REFRESHES.labels('upstream').inc()
+        except Exception as e:
+            PREWARM_REFRESHES.labels('error').inc()
+            logger.warning(f'Prewarming "{query}" failed: {e or type(e).__name__}')
+        await asyncio.sleep(call_spacing)
+
+async def prewarm_search_cache():
+    """Refresh popular queries before their cache entries expire, within PREWARM_CALLS_PER_MINUTE"""
+    call_spacing = 60 / PREWARM_CALLS_PER_MINUTE
+    popular, loaded_at = [], None
+    while True:
+        if loaded_at is None or time.monotonic() - loaded_at > PREWARM_LIST_REFRESH:
+            try:
+                popular = await asyncio.to_thread(load_popular_queries)
+                loaded_at = time.monotonic()
+            except Exception as e:
+                logger.error(f'Error loading popular queries for prewarming: {e}')
+        
+        try:
+            await prewarm_round(popular, call_spacing)
+        except Exception as e:
+            # A failed round must not end the task: nothing awaits it, so it would stop silently
+            logger.error(f'Error prewarming search cache: {e}')
+        
+        await asyncio.sleep(PREWARM_INTERVAL)
+
+# Result sessions backing the "more results" buttons (per chat) and inline query offsets (per query)
+RESULTS_PAGE_SIZE = 10
+RESULT_SESSION_TTL = float(os.getenv('RESULT_SESSION_TTL', '1800'))
+RESULT_SESSION_MAX_ENTRIES = int(os.getenv('RESULT_SESSION_MAX_ENTRIES', '5000'))
+RESULT_SESSION_MAX_BYTES = int(os.getenv('RESULT_SESSION_MAX_BYTES', str(64 * 1024 * 1024)))
+
+result_sessions = TTLCache(RESULT_SESSION_TTL, RESULT_SESSION_MAX_ENTRIES, RESULT_SESSION_MAX_BYTES)
+
+def start_result_session(session_key, query, query_key, result):
+    """Remember a search result for paging; replaces the previous session under the same key"""
+    session = {
+        'id': secrets.token_hex(4),
+        'query': query,
+        'query_key': query_key,
+        # Copied so that extending the session never mutates the cached page
+        'tracks': list(result['tracks']),
+        'total': result['total'],
+        'upstream_pages': 1,
+        # Inline sessions are shared by every user typing the same query
+        'lock': asyncio.Lock()
+    }
+    result_sessions.set(session_key, session)
+    return session
+
+async def load_results_page(session, page):
+    """Return the tracks of a results page, fetching further upstream pages if needed"""
+    needed = min((page + 1) * RESULTS_PAGE_SIZE, session['total'])
+    if len(session['tracks']) < needed:
+        # One extender at a time, so concurrent pagers never append the same upstream page twice
+        async with session['lock']:
+            while len(session['tracks']) < min(needed, session['total']):
+                result = await search_tracks(
+                    session['query'], page=session['upstream_pages'], query_key=session['query_key']
+                )
+                session['upstream_pages'] += 1
+                if not result['tracks']:
+                    session['total'] = len(session['tracks'])
+                    break
+                session['tracks'].extend(result['tracks'])
+    
+    start = page * RESULTS_PAGE_SIZE
+    return session['tracks'][start:start + RESULTS_PAGE_SIZE]
+
+def render_results_page(session, page):
+    start = page * RESULTS_PAGE_SIZE
+    tracks = session['tracks'][start:start + RESULTS_PAGE_SIZE]
+    
+    response = f'🎵 Найдено: {session["total"]} треков (показаны {start + 1}-{start + len(tracks)})\n\n'
+    response += format_tracks(tracks, start + 1)
+    
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton('◀️ Назад', callback_data=f'res:{session["id"]}:{page - 1}'))
+    if start + len(tracks) < session['total']:
+        buttons.append(InlineKeyboardButton('Ещё результаты ▶️', callback_data=f'res:{session["id"]}:{page + 1}'))
+    reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    
+    return response, reply_markup
+
+def get_track_url(track):
+    if not track['album_id']:
+        return None
+    return f'https://music.yandex.ru/album/{track["album_id"]}/track/{track["id"]}'
+
+def format_duration(duration_ms):
+    duration_seconds = duration_ms // 1000 if duration_ms else 0
+    return f'{duration_seconds // 60}:{duration_seconds % 60:02d}'
+
+def format_tracks(tracks, start=1):
+    response = ''
+    for i, track in enumerate(tracks, start):
+        artists = ', '.join(track['artists'])
+        
+        response += f'{i}. {artists} - {track["title"]}\n'
+        response += f'   ⏱ {format_duration(track["duration_ms"])}\n'
+        
+        track_url = get_track_url(track)
+        if track_url:
+            response += f'   🔗 {track_url}\n'
+        
+        response += '\n'
+    return response
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     log_user(user.id, user.username, user.first_name, user.last_name)
@@ -232,14 +1331,16 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     help_text = "🎵 Доступные команды:\n\n"
     help_text += "/start - Приветственное сообщение\n"
-    help_text += "/search <название> - Поиск в Яндекс.Музыке (10 результатов)\n"
+    help_text += "/search <название> - Поиск в Яндекс.Музыке (по 10 результатов)\n"
     help_text += "/my_stats - Ваша личная статистика\n"
     help_text += "/help - Показать это сообщение\n"
     
     if user_is_admin:
         help_text += "\n👑 АДМИНИСТРАТОР:\n"
         help_text += "/admin_stats - Общая статистика бота\n"
+        help_text += "/backfill_stats - Пересчитать статистику по всей истории\n"
         help_text += "/bot_uptime - Время запуска и работа бота (МСК)\n"
+        help_text += "/profile <N> - Профиль следующих N обновлений (cProfile)\n"
         help_text += "/user_actions <user_id или @username> - Действия пользователя\n"
         help_text += "/list_users - Список всех пользователей и ролей\n"
         help_text += "/add_admin <user_id или @username> - Добавить администратора\n"
@@ -253,6 +1354,9 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(help_text)
 
+RATE_LIMITED_TEXT = '⏳ Слишком много запросов. Подождите немного и попробуйте снова.'
+UPSTREAM_BUSY_TEXT = '⏳ Яндекс.Музыка сейчас перегружена запросами, попробуйте через минуту.'
+
 async def search_music(update: Update, context: ContextTypes.DEFAULT_TYPE):
     global yandex_client
     
@@ -273,41 +1377,31 @@ async def search_music(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text('❌ Яндекс.Музыка не настроена.')
             return
         
+        if not allow_search(user.id):
+            await update.message.reply_text(RATE_LIMITED_TEXT)
+            return
+        
         await update.message.reply_text(f'🔍 Ищу: {query}...')
         
-        search_result = yandex_client.search(query, type_='track')
+        query_key = canonical_query(query)
+        result = await search_tracks(query, query_key=query_key)
         
-        if not search_result or not search_result.tracks:
+        if not result['tracks']:
             await update.message.reply_text('❌ Ничего не найдено. Попробуйте другой запрос.')
             return
         
-        tracks = search_result.tracks.results[:10]
-        log_search(user.id, query, len(tracks))
+        session = start_result_session(update.message.chat_id, query, query_key, result)
+        tracks = session['tracks'][:RESULTS_PAGE_SIZE]
+        log_search(user.id, query, query_key, len(tracks))
         log_action(user.id, 'поиск /search', query)
         
-        response = f'🎵 Найдено: {len(tracks)} треков\n\n'
+        response, reply_markup = render_results_page(session, 0)
         
-        for i, track in enumerate(tracks, 1):
-            artists = ', '.join([artist.name for artist in track.artists])
-            duration_seconds = track.duration_ms // 1000 if track.duration_ms else 0
-            minutes = duration_seconds // 60
-            seconds = duration_seconds % 60
-            
-            log_track_view(user.id, track.title, artists, query)
-            
-            response += f'{i}. {artists} - {track.title}\n'
-            response += f'   ⏱ {minutes}:{seconds:02d}\n'
-            
-            if track.albums and len(track.albums) > 0:
-                album_id = track.albums[0].id
-                track_id = track.id
-                track_url = f'https://music.yandex.ru/album/{album_id}/track/{track_id}'
-                response += f'   🔗 {track_url}\n'
-            
-            response += '\n'
-        
-        await update.message.reply_text(response)
+        log_track_views(user.id, tracks, query_key)
+        await update.message.reply_text(response, reply_markup=reply_markup)
         
+    except UpstreamBusyError:
+        await update.message.reply_text(UPSTREAM_BUSY_TEXT)
     except Exception as e:
         logger.error(f'Ошибка поиска: {e}')
         await update.message.reply_text(f'❌ Ошибка при поиске: {str(e)}')
@@ -325,45 +1419,166 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     query = update.message.text
     
+    if not allow_search(user.id):
+        await update.message.reply_text(RATE_LIMITED_TEXT)
+        return
+    
     try:
         await update.message.reply_text(f'🔍 Ищу: {query}...')
         
-        search_result = yandex_client.search(query, type_='track')
+        query_key = canonical_query(query)
+        result = await search_tracks(query, query_key=query_key)
         
-        if not search_result or not search_result.tracks:
+        if not result['tracks']:
             await update.message.reply_text('❌ Ничего не найдено. Попробуйте другой запрос.')
             return
         
-        tracks = search_result.tracks.results[:10]
-        log_search(user.id, query, len(tracks))
+        session = start_result_session(update.message.chat_id, query, query_key, result)
+        tracks = session['tracks'][:RESULTS_PAGE_SIZE]
+        log_search(user.id, query, query_key, len(tracks))
         
-        response = f'🎵 Найдено: {len(tracks)} треков\n\n'
+        response, reply_markup = render_results_page(session, 0)
         
-        for i, track in enumerate(tracks, 1):
-            artists = ', '.join([artist.name for artist in track.artists])
-            duration_seconds = track.duration_ms // 1000 if track.duration_ms else 0
-            minutes = duration_seconds // 60
-            seconds = duration_seconds % 60
-            
-            log_track_view(user.id, track.title, artists, query)
-            
-            response += f'{i}. {artists} - {track.title}\n'
-            response += f'   ⏱ {minutes}:{seconds:02d}\n'
-            
-            if track.albums and len(track.albums) > 0:
-                album_id = track.albums[0].id
-                track_id = track.id
-                track_url = f'https://music.yandex.ru/album/{album_id}/track/{track_id}'
-                response += f'   🔗 {track_url}\n'
-            
-            response += '\n'
-        
-        await update.message.reply_text(response)
+        log_track_views(user.id, tracks, query_key)
+        await update.message.reply_text(response, reply_markup=reply_markup)
         
+    except UpstreamBusyError:
+        await update.message.reply_text(UPSTREAM_BUSY_TEXT)
     except Exception as e:
         logger.error(f'Ошибка поиска: {e}')
         await update.message.reply_text(f'❌ Ошибка при поиске: {str(e)}')
 
+async def search_results_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    callback = update.callback_query
+    user = callback.from_user
+    
+    _, session_id, page = callback.data.split(':')
+    page = int(page)
+    
+    session = result_sessions.get(callback.message.chat_id)
+    if not session or session['id'] != session_id:
+        await callback.answer('⌛ Результаты устарели, повторите поиск.', show_alert=True)
+        return
+    
+    if not allow_search(user.id):
+        await callback.answer(RATE_LIMITED_TEXT, show_alert=True)
+        return
+    
+    try:
+        tracks = await load_results_page(session, page)
+    except UpstreamBusyError:
+        await callback.answer(UPSTREAM_BUSY_TEXT, show_alert=True)
+        return
+    except Exception as e:
+        logger.error(f'Ошибка поиска: {e}')
+        await callback.answer('❌ Ошибка при поиске, попробуйте позже.', show_alert=True)
+        return
+    
+    # Store again so the cache accounts for the tracks added to the session
+    result_sessions.set(callback.message.chat_id, session)
+    
+    if not tracks:
+        await callback.answer('Больше результатов нет.')
+        return
+    
+    await callback.answer()
+    log_action(user.id, 'поиск: страница результатов', f'{session["query"]} (стр. {page + 1})')
+    log_track_views(user.id, tracks, session['query_key'])
+    
+    response, reply_markup = render_results_page(session, page)
+    await callback.edit_message_text(response, reply_markup=reply_markup)
+
+# Inline mode (@bot query) settings
+INLINE_DEBOUNCE = float(os.getenv('INLINE_DEBOUNCE', '0.4'))
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', '300'))
+INLINE_MIN_QUERY_LENGTH = 2
+
+# Latest inline query id per user, used to drop keystrokes superseded during the debounce delay
+_inline_latest_queries = {}
+
+def find_prefix_result(canonical):
+    """Reuse a cached complete result of a shorter query typed a moment ago.
+    
+    If "metallic" returned every match it has, the results for "metallica"
+    are a subset of them and can be filtered locally without an upstream call.
+    """
+    words = canonical.split()
+    for length in range(len(canonical) - 1, INLINE_MIN_QUERY_LENGTH - 1, -1):
+        # A prefix of a canonical query is canonical too, so it can be hashed directly
+        result = search_cache.peek((query_id_for(canonical[:length].rstrip()), 0))
+        if result is None or len(result['tracks']) < result['total']:
+            continue
+        tracks = [
+            track for track in result['tracks']
+            if all(word in canonicalize_query(' '.join(track['artists']) + ' ' + track['title']) for word in words)
+        ]
+        if tracks:
+            return {'tracks': tracks, 'total': len(tracks)}
+    return None
+
+def build_inline_result(track):
+    artists = ', '.join(track['artists'])
+    track_url = get_track_url(track)
+    message = f'🎵 {artists} - {track["title"]}'
+    if track_url:
+        message += f'\n🔗 {track_url}'
+    return InlineQueryResultArticle(
+        id=str(track['id']),
+        title=track['title'],
+        description=f'{artists} · {format_duration(track["duration_ms"])}',
+        url=track_url,
+        input_message_content=InputTextMessageContent(message)
+    )
+
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    inline_query = update.inline_query
+    user = inline_query.from_user
+    query = inline_query.query.strip()
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    
+    if len(query) < INLINE_MIN_QUERY_LENGTH or not yandex_client:
+        await inline_query.answer([], cache_time=INLINE_CACHE_TIME)
+        return
+    
+    if offset == 0:
+        # Inline queries fire on every keystroke: wait a little and answer only the latest one
+        _inline_latest_queries[user.id] = inline_query.id
+        await asyncio.sleep(INLINE_DEBOUNCE)
+        if _inline_latest_queries.get(user.id) != inline_query.id:
+            return
+        del _inline_latest_queries[user.id]
+    
+    if not allow_search(user.id):
+        await inline_query.answer([], cache_time=0)
+        return
+    
+    try:
+        query_key = canonical_query(query)
+        session_key = ('inline', query_key[0])
+        session = result_sessions.get(session_key)
+        if session is None:
+            result = find_prefix_result(query_key[1]) or await search_tracks(query, query_key=query_key)
+            session = start_result_session(session_key, query, query_key, result)
+        
+        tracks = await load_results_page(session, offset // RESULTS_PAGE_SIZE)
+        result_sessions.set(session_key, session)
+    except Exception as e:
+        logger.error(f'Ошибка inline-поиска: {e}')
+        await inline_query.answer([], cache_time=0)
+        return
+    
+    next_offset = offset + len(tracks)
+    await inline_query.answer(
+        [build_inline_result(track) for track in tracks],
+        cache_time=INLINE_CACHE_TIME,
+        next_offset=str(next_offset) if tracks and next_offset < session['total'] else ''
+    )
+    
+    if offset == 0:
+        log_user(user.id, user.username, user.first_name, user.last_name)
+        log_search(user.id, query, query_key, len(tracks))
+        log_action(user.id, 'поиск (inline)', query)
+
 async def unknown_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     log_user(user.id, user.username, user.first_name, user.last_name)
@@ -389,58 +1604,97 @@ def get_user_id_by_username(username):
         if username.startswith('@'):
             username = username[1:]
         
-        conn = get_db_connection()
-        if not conn:
-            return None
-        cur = conn.cursor()
-        
-        cur.execute("SELECT user_id FROM users WHERE username = %s", (username,))
-        result = cur.fetchone()
-        cur.close()
-        conn.close()
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT user_id FROM users WHERE username = %s", (username,))
+            result = cur.fetchone()
         
         return result[0] if result else None
     except Exception as e:
         logger.error(f'Error getting user_id by username: {e}')
         return None
 
+def parse_admin_user_id(value):
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        logger.error(f'Invalid ADMIN_USER_ID: {value}')
+        return None
+
+MAIN_ADMIN_ID = parse_admin_user_id(os.getenv('ADMIN_USER_ID'))
+ADMIN_CACHE_TTL = float(os.getenv('ADMIN_CACHE_TTL', '300'))
+
+_admin_ids = set()
+_admin_ids_loaded_at = None
+# Guards _admin_ids and _admin_changes: reloads run in a background thread
+_admin_ids_lock = threading.Lock()
+# user_id -> True (added) / False (removed) since the running reload started reading
+_admin_changes = {}
+
+def load_admin_ids():
+    """Reload the in-memory admin set from the admins table"""
+    global _admin_ids, _admin_ids_loaded_at
+    with _admin_ids_lock:
+        _admin_changes.clear()
+    try:
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT user_id FROM admins")
+            admin_ids = set(row[0] for row in cur.fetchall())
+    except Exception as e:
+        logger.error(f'Error loading admins: {e}')
+        return _admin_ids
+    
+    with _admin_ids_lock:
+        # /add_admin and /remove_admin may have committed after the read began
+        for user_id, added in _admin_changes.items():
+            if added:
+                admin_ids.add(user_id)
+            else:
+                admin_ids.discard(user_id)
+        _admin_changes.clear()
+        _admin_ids = admin_ids
+        _admin_ids_loaded_at = time.monotonic()
+    return _admin_ids
+
+def apply_admin_change(user_id, added):
+    """Update the cached admin set right after a change is committed"""
+    with _admin_ids_lock:
+        if added:
+            _admin_ids.add(user_id)
+        else:
+            _admin_ids.discard(user_id)
+        _admin_changes[user_id] = added
+
+_admin_refresh_lock = threading.Lock()
+
+def _refresh_admin_ids():
+    try:
+        load_admin_ids()
+    finally:
+        _admin_refresh_lock.release()
+
+def get_admin_ids():
+    """Return the cached admin set, refreshing it in the background once it is stale"""
+    if _admin_ids_loaded_at is None or time.monotonic() - _admin_ids_loaded_at > ADMIN_CACHE_TTL:
+        # Handlers call this on the event loop, so the reload must not block it
+        if _admin_refresh_lock.acquire(blocking=False):
+            threading.Thread(target=_refresh_admin_ids, daemon=True).start()
+    return _admin_ids
+
 def is_admin(user_id):
-    """Check if user is admin (from DB or env var)"""
-    main_admin_id = os.getenv('ADMIN_USER_ID')
-    if main_admin_id and int(main_admin_id) == user_id:
-        return True
-    
-    try:
-        conn = get_db_connection()
-        if not conn:
-            return False
-        cur = conn.cursor()
-        
-        cur.execute("SELECT user_id FROM admins WHERE user_id = %s", (user_id,))
-        result = cur.fetchone()
-        cur.close()
-        conn.close()
-        
-        return result is not None
-    except Exception as e:
-        logger.error(f'Error checking admin status: {e}')
-        return False
+    """Check if user is admin (from env var or cached admins table)"""
+    return user_id == MAIN_ADMIN_ID or user_id in get_admin_ids()
 
 def add_admin_to_db(target_user_id, added_by_user_id):
     """Add user to admins table"""
     try:
-        conn = get_db_connection()
-        if not conn:
-            return False
-        cur = conn.cursor()
-        
-        cur.execute(
-            "INSERT INTO admins (user_id, added_by) VALUES (%s, %s) ON CONFLICT DO NOTHING",
-            (target_user_id, added_by_user_id)
-        )
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO admins (user_id, added_by) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+                (target_user_id, added_by_user_id)
+            )
+        apply_admin_change(target_user_id, True)
         return True
     except Exception as e:
         logger.error(f'Error adding admin: {e}')
@@ -449,88 +1703,96 @@ def add_admin_to_db(target_user_id, added_by_user_id):
 def remove_admin_from_db(target_user_id):
     """Remove user from admins table"""
     try:
-        conn = get_db_connection()
-        if not conn:
-            return False
-        cur = conn.cursor()
-        
-        cur.execute("DELETE FROM admins WHERE user_id = %s", (target_user_id,))
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM admins WHERE user_id = %s", (target_user_id,))
+        apply_admin_change(target_user_id, False)
         return True
     except Exception as e:
         logger.error(f'Error removing admin: {e}')
         return False
 
-def get_all_users():
-    """Get all users with their roles"""
+USERS_PAGE_SIZE = int(os.getenv('USERS_PAGE_SIZE', '20'))
+
+def get_user_role(user_id):
+    if user_id == MAIN_ADMIN_ID:
+        return 'Главный админ 👑'
+    if user_id in get_admin_ids():
+        return 'Админ 🔑'
+    return 'Пользователь 👤'
+
+def get_users_page(after=None, before=None, limit=USERS_PAGE_SIZE):
+    """Get one page of users with roles, ordered by (total_uses, user_id) descending.
+    
+    Keyset pagination: after/before is the (total_uses, user_id) of the last/first
+    row of the page the user navigates from, so each call reads only its own rows.
+    """
     try:
-        conn = get_db_connection()
-        if not conn:
-            return None
-        cur = conn.cursor()
-        main_admin_id = os.getenv('ADMIN_USER_ID')
-        
-        cur.execute("""
-            SELECT user_id, username, first_name, total_uses, total_searches, created_at
-            FROM users
-            ORDER BY total_uses DESC
-        """)
-        users = cur.fetchall()
-        
-        # Get all admins from DB
-        cur.execute("SELECT user_id FROM admins")
-        admin_ids = set(row[0] for row in cur.fetchall())
-        
-        cur.close()
-        conn.close()
-        
-        users_with_roles = []
-        for user in users:
-            user_id = user[0]
-            if main_admin_id and int(main_admin_id) == user_id:
-                role = 'Главный админ 👑'
-            elif user_id in admin_ids:
-                role = 'Админ 🔑'
+        with db_connection() as conn, conn.cursor() as cur:
+            if before:
+                cur.execute("""
+                    SELECT user_id, username, first_name, total_uses, total_searches, created_at
+                    FROM users
+                    WHERE (total_uses, user_id) > (%s, %s)
+                    ORDER BY total_uses ASC, user_id ASC
+                    LIMIT %s
+                """, (before[0], before[1], limit + 1))
+                users = cur.fetchall()
+                has_prev = len(users) > limit
+                users = users[:limit][::-1]
+                has_next = True
             else:
-                role = 'Пользователь 👤'
-            users_with_roles.append((user, role))
+                if after:
+                    cur.execute("""
+                        SELECT user_id, username, first_name, total_uses, total_searches, created_at
+                        FROM users
+                        WHERE (total_uses, user_id) < (%s, %s)
+                        ORDER BY total_uses DESC, user_id DESC
+                        LIMIT %s
+                    """, (after[0], after[1], limit + 1))
+                else:
+                    cur.execute("""
+                        SELECT user_id, username, first_name, total_uses, total_searches, created_at
+                        FROM users
+                        ORDER BY total_uses DESC, user_id DESC
+                        LIMIT %s
+                    """, (limit + 1,))
+                users = cur.fetchall()
+                has_next = len(users) > limit
+                users = users[:limit]
+                has_prev = after is not None
         
-        return users_with_roles
+        return {
+            'users': [(user, get_user_role(user[0])) for user in users],
+            'has_prev': has_prev,
+            'has_next': has_next
+        }
     except Exception as e:
-        logger.error(f'Error getting all users: {e}')
+        logger.error(f'Error getting users page: {e}')
         return None
 
 def get_user_actions(user_id, limit=50):
     """Get user actions with timestamps"""
     try:
-        conn = get_db_connection()
-        if not conn:
-            return None
-        cur = conn.cursor()
-        
-        cur.execute("""
-            SELECT username, first_name, total_uses, total_searches
-            FROM users
-            WHERE user_id = %s
-        """, (user_id,))
-        user_info = cur.fetchone()
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                SELECT username, first_name, total_uses, total_searches
+                FROM users
+                WHERE user_id = %s
+            """, (user_id,))
+            user_info = cur.fetchone()
         
-        if not user_info:
-            return None
+            if not user_info:
+                return None
         
-        cur.execute("""
-            SELECT action_type, action_details, created_at
-            FROM user_actions
-            WHERE user_id = %s
-            ORDER BY created_at DESC
-            LIMIT %s
-        """, (user_id, limit))
+            cur.execute("""
+                SELECT action_type, action_details, created_at
+                FROM user_actions
+                WHERE user_id = %s
+                ORDER BY created_at DESC
+                LIMIT %s
+            """, (user_id, limit))
         
-        actions = cur.fetchall()
-        cur.close()
-        conn.close()
+            actions = cur.fetchall()
         
         return {
             'user_info': user_info,
@@ -543,19 +1805,13 @@ def get_user_actions(user_id, limit=50):
 def get_bot_uptime():
     """Get bot startup time and calculate uptime"""
     try:
-        conn = get_db_connection()
-        if not conn:
-            return None
-        cur = conn.cursor()
-        
-        cur.execute("""
-            SELECT started_at 
-            FROM bot_sessions 
-            ORDER BY started_at DESC LIMIT 1
-        """)
-        session_result = cur.fetchone()
-        cur.close()
-        conn.close()
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                SELECT started_at 
+                FROM bot_sessions 
+                ORDER BY started_at DESC LIMIT 1
+            """)
+            session_result = cur.fetchone()
         
         if not session_result:
             return None
@@ -572,118 +1828,164 @@ def get_bot_uptime():
 
 def get_admin_stats():
     try:
-        conn = get_db_connection()
-        if not conn:
-            return None
-        cur = conn.cursor()
+        with db_connection() as conn, conn.cursor() as cur:
+            stats = {}
         
-        stats = {}
-        
-        cur.execute('SELECT COUNT(*) FROM users')
-        stats['total_users'] = cur.fetchone()[0]
-        
-        cur.execute('SELECT SUM(total_searches) FROM users')
-        stats['total_searches'] = cur.fetchone()[0] or 0
-        
-        cur.execute('SELECT SUM(total_uses) FROM users')
-        stats['total_uses'] = cur.fetchone()[0] or 0
+            # History-sized counts come from the rollup tables kept by the analytics writer
+            cur.execute("""
+                SELECT (SELECT COUNT(*) FROM users),
+                       (SELECT COALESCE(SUM(total_searches), 0) FROM users),
+                       (SELECT COALESCE(SUM(total_uses), 0) FROM users),
+                       (SELECT COUNT(*) FROM users WHERE total_searches >= 5),
+                       (SELECT COALESCE(SUM(track_views), 0) FROM stats_daily),
+                       (SELECT COUNT(*) FROM query_stats)
+            """)
+            (stats['total_users'], stats['total_searches'], stats['total_uses'],
+             stats['active_users'], stats['total_track_views'], stats['unique_searches']) = cur.fetchone()
         
-        cur.execute('SELECT COUNT(*) FROM track_views')
-        stats['total_track_views'] = cur.fetchone()[0]
+            cur.execute("""
+                SELECT searches, track_views FROM stats_daily
+                WHERE day = (CURRENT_TIMESTAMP AT TIME ZONE 'UTC')::date
+            """)
+            today = cur.fetchone()
+            stats['today_searches'], stats['today_track_views'] = today if today else (0, 0)
+        
+            if stats['total_users'] > 0:
+                stats['avg_searches_per_user'] = round(stats['total_searches'] / stats['total_users'], 2)
+            else:
+                stats['avg_searches_per_user'] = 0
         
-        cur.execute('SELECT COUNT(DISTINCT query) FROM searches')
-        stats['unique_searches'] = cur.fetchone()[0]
+            if stats['total_searches'] > 0:
+                stats['avg_views_per_search'] = round(stats['total_track_views'] / stats['total_searches'], 2)
+            else:
+                stats['avg_views_per_search'] = 0
         
-        if stats['total_users'] > 0:
-            stats['avg_searches_per_user'] = round(stats['total_searches'] / stats['total_users'], 2)
-        else:
-            stats['avg_searches_per_user'] = 0
+            # Get top 10 users with their last interaction and last search.
+            # Each lateral lookup is a single probe of a (user_id, created_at DESC) index
+            cur.execute("""
+                SELECT u.user_id, u.username, u.first_name, u.total_uses, u.total_searches,
+                       ua.created_at as last_interaction,
+                       ua.action_type,
+                       ua.action_details,
+                       s.query as last_search
+                FROM (
+                    SELECT user_id, username, first_name, total_uses, total_searches
+                    FROM users
+                    ORDER BY total_uses DESC
+                    LIMIT 10
+                ) u
+                LEFT JOIN LATERAL (
+                    SELECT action_type, action_details, created_at
+                    FROM user_actions
+                    WHERE user_id = u.user_id
+                    ORDER BY created_at DESC
+                    LIMIT 1
+                ) ua ON true
+                LEFT JOIN LATERAL (
+                    SELECT query
+                    FROM searches
+                    WHERE user_id = u.user_id
+                    ORDER BY created_at DESC
+                    LIMIT 1
+                ) s ON true
+                ORDER BY u.total_uses DESC
+            """)
+            stats['top_users'] = cur.fetchall()
         
-        if stats['total_searches'] > 0:
-            stats['avg_views_per_search'] = round(stats['total_track_views'] / stats['total_searches'], 2)
-        else:
-            stats['avg_views_per_search'] = 0
+            cur.execute("""
+                SELECT q.canonical, s.searches
+                FROM query_stats s
+                JOIN queries q ON q.id = s.query_id
+                ORDER BY s.searches DESC
+                LIMIT 10
+            """)
+            stats['popular_queries'] = cur.fetchall()
         
-        cur.execute('SELECT COUNT(*) FROM users WHERE total_searches >= 5')
-        stats['active_users'] = cur.fetchone()[0]
+            cur.execute("""
+                SELECT a.name, s.views
+                FROM artist_stats s
+                JOIN artists a ON a.id = s.artist_id
+                ORDER BY s.views DESC
+                LIMIT 5
+            """)
+            stats['popular_artists'] = cur.fetchall()
         
-        # Get top 10 users with their last interaction info
+        return stats
+    except Exception as e:
+        logger.error(f'Error getting admin stats: {e}')
+        return None
+
+def get_user_stats(user_id):
+    """Get personal statistics for /my_stats"""
+    with db_connection() as conn, conn.cursor() as cur:
         cur.execute("""
-            SELECT u.user_id, u.username, u.first_name, u.total_uses, u.total_searches,
-                   ua.created_at as last_interaction,
-                   ua.action_type,
-                   ua.action_details
-            FROM users u
-            LEFT JOIN LATERAL (
-                SELECT action_type, action_details, created_at
-                FROM user_actions
-                WHERE user_id = u.user_id
-                ORDER BY created_at DESC
-                LIMIT 1
-            ) ua ON true
-            ORDER BY u.total_uses DESC 
-            LIMIT 10
-        """)
-        stats['top_users'] = cur.fetchall()
+            SELECT username, first_name, total_uses, total_searches, created_at 
+            FROM users 
+            WHERE user_id = %s
+        """, (user_id,))
+        user_info = cur.fetchone()
         
-        # Get last search query for each top user
-        top_user_ids = [user[0] for user in stats['top_users']]
-        stats['user_last_searches'] = {}
-        for uid in top_user_ids:
-            cur.execute("""
-                SELECT query FROM searches 
-                WHERE user_id = %s 
-                ORDER BY created_at DESC 
-                LIMIT 1
-            """, (uid,))
-            result = cur.fetchone()
-            stats['user_last_searches'][uid] = result[0] if result else None
+        if not user_info:
+            return None
         
+        # Top queries
         cur.execute("""
-            SELECT query, COUNT(*) as count 
-            FROM searches 
-            GROUP BY query 
-            ORDER BY count DESC 
-            LIMIT 10
-        """)
-        stats['popular_queries'] = cur.fetchall()
+            SELECT q.canonical, v.count
+            FROM (
+                SELECT query_id, COUNT(*) as count
+                FROM searches
+                WHERE user_id = %s AND query_id IS NOT NULL
+                GROUP BY query_id
+                ORDER BY count DESC
+                LIMIT 5
+            ) v
+            JOIN queries q ON q.id = v.query_id
+            ORDER BY v.count DESC
+        """, (user_id,))
+        top_queries = cur.fetchall()
         
+        # Track views stats
         cur.execute("""
-            SELECT track_artists, COUNT(*) as count 
-            FROM track_views 
-            WHERE track_artists IS NOT NULL AND track_artists != ''
-            GROUP BY track_artists 
-            ORDER BY count DESC 
-            LIMIT 5
-        """)
-        stats['popular_artists'] = cur.fetchall()
+            SELECT COUNT(*) FROM track_views 
+            WHERE user_id = %s
+        """, (user_id,))
+        total_track_views = cur.fetchone()[0]
         
-        cur.close()
-        conn.close()
-        return stats
-    except Exception as e:
-        logger.error(f'Error getting admin stats: {e}')
-        return None
-
-async def list_users_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
+        # Popular artists, grouped by artist id before the names are joined in
+        cur.execute("""
+            SELECT a.name, v.count
+            FROM (
+                SELECT ta.artist_id, COUNT(*) as count
+                FROM track_views tv
+                JOIN track_artists ta ON ta.track_id = tv.track_id
+                WHERE tv.user_id = %s
+                GROUP BY ta.artist_id
+                ORDER BY count DESC
+                LIMIT 3
+            ) v
+            JOIN artists a ON a.id = v.artist_id
+            ORDER BY v.count DESC
+        """, (user_id,))
+        favorite_artists = cur.fetchall()
     
-    if not is_admin(user_id):
-        await update.message.reply_text('❌ У вас нет доступа к этой команде.')
-        logger.warning(f'Unauthorized list_users access attempt by user {user_id}')
-        return
+    return {
+        'user_info': user_info,
+        'top_queries': top_queries,
+        'total_track_views': total_track_views,
+        'favorite_artists': favorite_artists
+    }
+
+def render_users_page(users_page, page):
+    users = users_page['users']
     
-    log_action(user_id, 'команда /list_users')
+    response = f'👥 СПИСОК ПОЛЬЗОВАТЕЛЕЙ (стр. {page})\n\n'
+    response += '='*50 + '\n\n'
     
-    users = get_all_users()
     if not users:
-        await update.message.reply_text('❌ Ошибка при получении списка пользователей.')
-        return
-    
-    response = f'👥 СПИСОК ВСЕХ ПОЛЬЗОВАТЕЛЕЙ ({len(users)})\n\n'
-    response += '='*50 + '\n\n'
+        response += 'Пользователей пока нет.'
     
-    for i, (user_data, role) in enumerate(users, 1):
+    first_number = (page - 1) * USERS_PAGE_SIZE + 1
+    for i, (user_data, role) in enumerate(users, first_number):
         uid = user_data[0]
         username = user_data[1]
         first_name = user_data[2]
@@ -696,9 +1998,61 @@ async def list_users_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         response += f'   Роль: {role}\n'
         response += f'   Взаимодействий: {total_uses} | Поисков: {total_searches}\n\n'
     
-    await update.message.reply_text(response)
+    # Callback data carries the keyset cursor: users:<direction>:<total_uses>:<user_id>:<target page>
+    buttons = []
+    if users and users_page['has_prev']:
+        first = users[0][0]
+        buttons.append(InlineKeyboardButton('◀️ Назад', callback_data=f'users:prev:{first[3]}:{first[0]}:{page - 1}'))
+    if users and users_page['has_next']:
+        last = users[-1][0]
+        buttons.append(InlineKeyboardButton('Далее ▶️', callback_data=f'users:next:{last[3]}:{last[0]}:{page + 1}'))
+    reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    
+    return response, reply_markup
+
+async def list_users_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    
+    if not is_admin(user_id):
+        await update.message.reply_text('❌ У вас нет доступа к этой команде.')
+        logger.warning(f'Unauthorized list_users access attempt by user {user_id}')
+        return
+    
+    log_action(user_id, 'команда /list_users')
+    
+    users_page = await asyncio.to_thread(get_users_page)
+    if users_page is None:
+        await update.message.reply_text('❌ Ошибка при получении списка пользователей.')
+        return
+    
+    response, reply_markup = render_users_page(users_page, 1)
+    await update.message.reply_text(response, reply_markup=reply_markup)
     logger.info(f'List users requested by admin {user_id}')
 
+async def list_users_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    
+    if not is_admin(user_id):
+        await query.answer('❌ У вас нет доступа к этой команде.', show_alert=True)
+        logger.warning(f'Unauthorized list_users access attempt by user {user_id}')
+        return
+    
+    _, direction, total_uses, cursor_user_id, page = query.data.split(':')
+    cursor = (int(total_uses), int(cursor_user_id))
+    if direction == 'prev':
+        users_page = await asyncio.to_thread(get_users_page, before=cursor)
+    else:
+        users_page = await asyncio.to_thread(get_users_page, after=cursor)
+    
+    if users_page is None:
+        await query.answer('❌ Ошибка при получении списка пользователей.', show_alert=True)
+        return
+    
+    await query.answer()
+    response, reply_markup = render_users_page(users_page, int(page))
+    await query.edit_message_text(response, reply_markup=reply_markup)
+
 async def user_actions_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     
@@ -719,12 +2073,12 @@ async def user_actions_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         target_user_id = int(arg)
     except ValueError:
         # Try to parse as username
-        target_user_id = get_user_id_by_username(arg)
+        target_user_id = await asyncio.to_thread(get_user_id_by_username, arg)
         if not target_user_id:
             await update.message.reply_text('❌ Пользователь не найден.')
             return
     
-    user_actions = get_user_actions(target_user_id, limit=30)
+    user_actions = await asyncio.to_thread(get_user_actions, target_user_id, limit=30)
     if not user_actions:
         await update.message.reply_text('❌ Пользователь не найден.')
         return
@@ -773,14 +2127,14 @@ async def add_admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         target_user_id = int(arg)
     except ValueError:
-        target_user_id = get_user_id_by_username(arg)
+        target_user_id = await asyncio.to_thread(get_user_id_by_username, arg)
         if not target_user_id:
             await update.message.reply_text('❌ Пользователь не найден.')
             return
     
     log_action(user_id, 'команда /add_admin', str(target_user_id))
     
-    if add_admin_to_db(target_user_id, user_id):
+    if await asyncio.to_thread(add_admin_to_db, target_user_id, user_id):
         await update.message.reply_text(f'✅ Пользователь {target_user_id} добавлен в админы.')
         logger.info(f'User {target_user_id} added to admins by {user_id}')
     else:
@@ -788,7 +2142,6 @@ async def add_admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def remove_admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    main_admin_id = os.getenv('ADMIN_USER_ID')
     
     if not is_admin(user_id):
         await update.message.reply_text('❌ У вас нет доступа к этой команде.')
@@ -805,7 +2158,7 @@ async def remove_admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         target_user_id = int(arg)
     except ValueError:
-        target_user_id = get_user_id_by_username(arg)
+        target_user_id = await asyncio.to_thread(get_user_id_by_username, arg)
         if not target_user_id:
             await update.message.reply_text('❌ Пользователь не найден.')
             return
@@ -813,11 +2166,11 @@ async def remove_admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     log_action(user_id, 'команда /remove_admin', str(target_user_id))
     
     # Prevent removing main admin
-    if main_admin_id and int(main_admin_id) == target_user_id:
+    if target_user_id == MAIN_ADMIN_ID:
         await update.message.reply_text('❌ Нельзя удалить главного администратора!')
         return
     
-    if remove_admin_from_db(target_user_id):
+    if await asyncio.to_thread(remove_admin_from_db, target_user_id):
         await update.message.reply_text(f'✅ Пользователь {target_user_id} удален из админов.')
         logger.info(f'User {target_user_id} removed from admins by {user_id}')
     else:
@@ -833,7 +2186,7 @@ async def bot_uptime(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     log_action(user_id, 'команда /bot_uptime')
     
-    uptime_data = get_bot_uptime()
+    uptime_data = await asyncio.to_thread(get_bot_uptime)
     if not uptime_data:
         await update.message.reply_text('❌ Ошибка при получении информации о боте.')
         return
@@ -849,7 +2202,15 @@ async def bot_uptime(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     response = '⏱ ИНФОРМАЦИЯ О БОТЕ (МСК)\n\n'
     response += f'🔄 Время запуска: {started_at.strftime("%d.%m.%Y %H:%M:%S")}\n'
-    response += f'⌛ Время работы: {days}д {hours}ч {minutes}м {seconds}с'
+    response += f'⌛ Время работы: {days}д {hours}ч {minutes}м {seconds}с\n'
+    
+    queue_stats = get_analytics_queue_stats()
+    response += f'📥 Очередь аналитики: {queue_stats["depth"]} | Записано: {queue_stats["written"]} | '
+    response += f'Потеряно: {queue_stats["dropped"] + queue_stats["failed"]}\n'
+    
+    cache_stats = search_cache.stats
+    response += f'🗂 Кэш поиска: {len(search_cache)} запросов | Попаданий: {cache_stats["hits"]} | '
+    response += f'Промахов: {cache_stats["misses"]} | Вытеснено: {cache_stats["evictions"]}'
     
     await update.message.reply_text(response)
     logger.info(f'Bot uptime requested by user {user_id}')
@@ -864,7 +2225,7 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     log_action(user_id, 'команда /admin_stats')
     
-    stats = get_admin_stats()
+    stats = await asyncio.to_thread(get_admin_stats)
     if not stats:
         await update.message.reply_text('❌ Ошибка при получении статистики.')
         return
@@ -875,11 +2236,11 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     response += f'💬 Всего взаимодействий: {stats["total_uses"]}\n'
     response += f'🔍 Всего поисков: {stats["total_searches"]}\n'
     response += f'📊 Средне поисков/пользователя: {stats["avg_searches_per_user"]}\n'
+    response += f'📅 Сегодня: {stats["today_searches"]} поисков | {stats["today_track_views"]} просмотров треков\n'
     response += '\n' + '='*50 + '\n\n'
     
     response += '🏆 ТОП 10 АКТИВНЫХ ПОЛЬЗОВАТЕЛЕЙ:\n'
     for i, user_data in enumerate(stats['top_users'], 1):
-        uid = user_data[0]
         username = user_data[1]
         first_name = user_data[2]
         uses = user_data[3]
@@ -887,6 +2248,7 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         last_interaction = user_data[5]
         action_type = user_data[6]
         query_text = user_data[7]
+        last_search = user_data[8]
         
         username_str = f'@{username}' if username else f'{first_name}'
         response += f'{i}. {username_str}\n'
@@ -909,7 +2271,6 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         response += '\n'
         
         # Add last search query if available
-        last_search = stats['user_last_searches'].get(uid)
         if last_search:
             response += f'   🔍 Последний поиск: "{last_search}"\n'
         
@@ -929,6 +2290,102 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(response)
     logger.info(f'Admin stats requested by user {user_id}')
 
+async def backfill_stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    
+    if not is_admin(user_id):
+        await update.message.reply_text('❌ У вас нет доступа к этой команде.')
+        logger.warning(f'Unauthorized backfill_stats access attempt by user {user_id}')
+        return
+    
+    log_action(user_id, 'команда /backfill_stats')
+    await update.message.reply_text('⏳ Пересчитываю статистику по всей истории...')
+    
+    started = time.monotonic()
+    try:
+        backfilled = await asyncio.to_thread(backfill_query_ids)
+        await asyncio.to_thread(rebuild_stats_rollups)
+    except Exception as e:
+        logger.error(f'Error rebuilding stats rollups: {e}')
+        await update.message.reply_text('❌ Ошибка при пересчёте статистики.')
+        return
+    
+    await update.message.reply_text(f'✅ Статистика пересчитана за {time.monotonic() - started:.1f} с.')
+    logger.info(f'Stats rollups rebuilt by admin {user_id}, query ids filled for {backfilled} rows')
+
+# /profile: cProfile of the event loop thread over the next N updates
+PROFILE_MAX_UPDATES = 1000
+PROFILE_TOP_FUNCTIONS = 20
+_profile_session = None
+
+async def profile_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global _profile_session
+    user_id = update.message.from_user.id
+    
+    if not is_admin(user_id):
+        await update.message.reply_text('❌ У вас нет доступа к этой команде.')
+        logger.warning(f'Unauthorized profile access attempt by user {user_id}')
+        return
+    
+    log_action(user_id, 'команда /profile')
+    
+    try:
+        updates = int(context.args[0]) if context.args else 50
+    except ValueError:
+        await update.message.reply_text('Использование: /profile <число обновлений>')
+        return
+    if not 1 <= updates <= PROFILE_MAX_UPDATES:
+        await update.message.reply_text(f'❌ Число обновлений должно быть от 1 до {PROFILE_MAX_UPDATES}.')
+        return
+    if _profile_session is not None:
+        await update.message.reply_text('⏳ Профилирование уже запущено.')
+        return
+    
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # Another profiler (or debugger) already owns the interpreter hooks
+        await update.message.reply_text(f'❌ Не удалось запустить профилировщик: {e}')
+        return
+    _profile_session = {
+        'profiler': profiler,
+        'updates': updates,
+        'remaining': updates,
+        'chat_id': update.message.chat_id
+    }
+    await update.message.reply_text(f'🔬 Профилирую следующие {updates} обновлений...')
+
+def format_profile(profiler, updates):
+    stats = pstats.Stats(profiler, stream=io.StringIO()).strip_dirs()
+    functions = sorted(
+        stats.get_stats_profile().func_profiles.items(), key=lambda item: item[1].cumtime, reverse=True
+    )
+    
+    response = f'🔬 ПРОФИЛЬ {updates} ОБНОВЛЕНИЙ\n'
+    response += '(cumulative / own time, вызовов; работа в to_thread видна как ожидание)\n\n'
+    for name, function in functions[:PROFILE_TOP_FUNCTIONS]:
+        response += (
+            f'{function.cumtime * 1000:.0f} / {function.tottime * 1000:.0f} мс, {function.ncalls}x '
+            f'{name} ({function.file_name}:{function.line_number})\n'
+        )
+    return response[:4000]
+
+async def finish_profiled_update(context):
+    """Count a handled update against the running /profile and send the report after the last one"""
+    global _profile_session
+    session = _profile_session
+    session['remaining'] -= 1
+    if session['remaining'] > 0:
+        return
+    
+    _profile_session = None
+    session['profiler'].disable()
+    try:
+        await context.bot.send_message(session['chat_id'], format_profile(session['profiler'], session['updates']))
+    except Exception as e:
+        logger.error(f'Error sending profile report: {e}')
+
 async def my_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     user_id = user.id
@@ -936,63 +2393,20 @@ async def my_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     log_action(user_id, 'команда /my_stats')
     
     try:
-        conn = get_db_connection()
-        if not conn:
-            await update.message.reply_text('❌ Ошибка подключения к базе данных.')
-            return
-        
-        cur = conn.cursor()
+        user_stats = await asyncio.to_thread(get_user_stats, user_id)
         
-        cur.execute("""
-            SELECT username, first_name, total_uses, total_searches, created_at 
-            FROM users 
-            WHERE user_id = %s
-        """, (user_id,))
-        result = cur.fetchone()
-        
-        if not result:
+        if not user_stats:
             await update.message.reply_text('❌ Ваши данные не найдены.')
-            cur.close()
-            conn.close()
             return
         
-        username, first_name, total_uses, total_searches, created_at = result
-        
-        # Top queries
-        cur.execute("""
-            SELECT query, COUNT(*) as count 
-            FROM searches 
-            WHERE user_id = %s 
-            GROUP BY query 
-            ORDER BY count DESC 
-            LIMIT 5
-        """, (user_id,))
-        my_queries = cur.fetchall()
-        
-        # Track views stats
-        cur.execute("""
-            SELECT COUNT(*) FROM track_views 
-            WHERE user_id = %s
-        """, (user_id,))
-        total_track_views = cur.fetchone()[0]
-        
-        # Popular artists
-        cur.execute("""
-            SELECT track_artists, COUNT(*) as count 
-            FROM track_views 
-            WHERE user_id = %s AND track_artists IS NOT NULL AND track_artists != ''
-            GROUP BY track_artists 
-            ORDER BY count DESC 
-            LIMIT 3
-        """, (user_id,))
-        favorite_artists = cur.fetchall()
+        username, first_name, total_uses, total_searches, created_at = user_stats['user_info']
+        my_queries = user_stats['top_queries']
+        total_track_views = user_stats['total_track_views']
+        favorite_artists = user_stats['favorite_artists']
         
         # Calculate average searches
         avg_per_session = round(total_searches / total_uses, 2) if total_uses > 0 else 0
         
-        cur.close()
-        conn.close()
-        
         # Convert created_at to MSK
         if created_at:
             if created_at.tzinfo is None:
@@ -1031,47 +2445,293 @@ async def my_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f'Error getting user stats: {e}')
         await update.message.reply_text('❌ Ошибка при получении статистики.')
 
+# Web server and webhook settings
+WEB_PORT = int(os.getenv('PORT', '8080'))
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+
+web_runner = None
+background_tasks = []
+
+def get_webhook_secret(token):
+    """Secret shared by all instances; Telegram echoes it in every webhook request"""
+    return os.getenv('WEBHOOK_SECRET') or hashlib.sha256(token.encode()).hexdigest()[:32]
+
+READY_CHECK_TIMEOUT = float(os.getenv('READY_CHECK_TIMEOUT', '5'))
+
 async def health_check(request):
     return web.Response(text='Bot is alive!')
 
-async def start_webserver():
+async def metrics_endpoint(request):
+    return web.Response(body=generate_latest(), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+def ping_db():
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute('SELECT 1')
+
+async def readiness_check(request):
+    """Report whether the warm-up has finished and Postgres and Yandex Music are reachable"""
+    checks = {'warm_up': 'ok' if bot_ready.is_set() else 'in progress'}
+    
+    try:
+        await asyncio.wait_for(asyncio.to_thread(ping_db), READY_CHECK_TIMEOUT)
+        checks['database'] = 'ok'
+    except Exception as e:
+        checks['database'] = f'error: {e or type(e).__name__}'
+    
+    if not yandex_client:
+        checks['yandex_music'] = 'not configured'
+    else:
+        try:
+            await asyncio.wait_for(yandex_client.account_status(), READY_CHECK_TIMEOUT)
+            checks['yandex_music'] = 'ok'
+        except Exception as e:
+            checks['yandex_music'] = f'error: {e or type(e).__name__}'
+    
+    ready = all(status == 'ok' for status in checks.values())
+    return web.json_response({'ready': ready, 'checks': checks}, status=200 if ready else 503)
+
+async def start_webserver(application=None):
+    global web_runner
     app = web.Application()
     app.router.add_get('/', health_check)
     app.router.add_get('/health', health_check)
-    runner = web.AppRunner(app)
-    await runner.setup()
-    site = web.TCPSite(runner, '0.0.0.0', 8080)
+    app.router.add_get('/ready', readiness_check)
+    app.router.add_get('/metrics', metrics_endpoint)
+    
+    if application and WEBHOOK_URL:
+        webhook_secret = get_webhook_secret(application.bot.token)
+        
+        async def telegram_webhook(request):
+            if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != webhook_secret:
+                return web.Response(status=403)
+            try:
+                data = await request.json()
+            except ValueError:
+                return web.Response(status=400)
+            await application.update_queue.put(Update.de_json(data, application.bot))
+            return web.Response()
+        
+        app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    
+    web_runner = web.AppRunner(app)
+    await web_runner.setup()
+    site = web.TCPSite(web_runner, '0.0.0.0', WEB_PORT)
     await site.start()
-    logger.info('Web server started on port 8080')
-    print('🌐 Keep-alive веб-сервер запущен на порту 8080')
+    logger.info(f'Web server started on port {WEB_PORT}')
+    print(f'🌐 Keep-alive веб-сервер запущен на порту {WEB_PORT}')
 
-def run_webserver():
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(start_webserver())
-    loop.run_forever()
+async def stop_webserver():
+    global web_runner
+    if web_runner:
+        await web_runner.cleanup()
+        web_runner = None
 
-def self_ping():
-    logger.info('Self-ping thread started')
+async def self_ping():
+    logger.info('Self-ping task started')
     print('🔄 Самопинг включен - бот будет пинговать себя каждые 5 минут')
     
-    time.sleep(10)
+    await asyncio.sleep(10)
+    
+    async with ClientSession(timeout=ClientTimeout(total=10)) as session:
+        while True:
+            try:
+                async with session.get(f'http://localhost:{WEB_PORT}/health') as response:
+                    if response.status == 200:
+                        logger.info('Self-ping successful')
+                    else:
+                        logger.warning(f'Self-ping returned status {response.status}')
+            except Exception as e:
+                logger.error(f'Self-ping failed: {e}')
+            
+            await asyncio.sleep(300)
+
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '32'))
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Process updates concurrently, but one at a time within each chat.
+    
+    Updates without a chat (inline queries) run fully concurrently, which the
+    inline debounce relies on.
+    """
+    
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        # chat_id -> [lock, number of updates holding or waiting for it]
+        self._chat_locks = {}
+    
+    async def process_update(self, update, coroutine):
+        # Overrides the base method, which takes a worker slot before do_process_update.
+        # Waiting for the chat's turn first keeps a backlog in one chat from holding
+        # every slot while the other chats wait
+        chat = getattr(update, 'effective_chat', None)
+        if chat is None:
+            await super().process_update(update, coroutine)
+            return
+        
+        entry = self._chat_locks.get(chat.id)
+        if entry is None:
+            entry = self._chat_locks[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[chat.id]
+    
+    async def do_process_update(self, update, coroutine):
+        await coroutine
     
-    while True:
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+
+# Startup: updates are accepted right away while the database and the Yandex
+# client warm up in the background; until then handlers answer WARMING_UP_TEXT
+STARTUP_SECONDS = Gauge('bot_startup_seconds', 'Seconds from process start to a startup milestone', ['milestone'])
+WARMING_UP_TEXT = '⏳ Бот запускается, попробуйте ещё раз через пару секунд.'
+# Handlers that need neither the database nor Yandex Music
+NO_WARM_UP_HANDLERS = {'start', 'help'}
+bot_ready = asyncio.Event()
+_first_reply_sent = False
+
+def record_startup_milestone(milestone):
+    seconds = time.monotonic() - PROCESS_STARTED
+    STARTUP_SECONDS.labels(milestone).set(seconds)
+    logger.info(f'Startup milestone {milestone}: {seconds:.2f} s after process start')
+
+def note_reply_sent():
+    global _first_reply_sent
+    if not _first_reply_sent:
+        _first_reply_sent = True
+        record_startup_milestone('first_reply')
+
+def init_database():
+    """Blocking half of the warm-up: migrations, admin cache and the uptime record"""
+    init_db()
+    load_admin_ids()
+    log_bot_startup()
+
+async def warm_up():
+    steps = [asyncio.to_thread(init_database)]
+    # The async client has to be created inside the application's event loop
+    yandex_token = os.getenv('YANDEX_MUSIC_TOKEN')
+    if yandex_token:
+        steps.append(init_yandex_client(yandex_token))
+    await asyncio.gather(*steps)
+    
+    # Writes and partition maintenance need the migrated schema; events queued meanwhile wait
+    start_analytics_writer()
+    background_tasks.append(asyncio.create_task(partition_maintenance()))
+    if SEARCH_CACHE_L2_TTL:
+        background_tasks.append(asyncio.create_task(search_cache_purger()))
+    if PREWARM_TOP_QUERIES > 0 and PREWARM_CALLS_PER_MINUTE > 0:
+        background_tasks.append(asyncio.create_task(prewarm_search_cache()))
+    bot_ready.set()
+    record_startup_milestone('ready')
+
+async def reply_warming_up(update):
+    if update.callback_query:
+        await update.callback_query.answer(WARMING_UP_TEXT)
+    elif update.inline_query:
+        await update.inline_query.answer([], cache_time=0, is_personal=True)
+    elif update.message:
+        await update.message.reply_text(WARMING_UP_TEXT)
+
+class TimedRequest(HTTPXRequest):
+    """Bot API transport that records time spent talking to Telegram as the 'send' phase"""
+    
+    async def do_request(self, *args, **kwargs):
+        started = time.perf_counter()
         try:
-            response = requests.get('http://localhost:8080/health', timeout=10)
-            if response.status_code == 200:
-                logger.info('Self-ping successful')
-            else:
-                logger.warning(f'Self-ping returned status {response.status_code}')
-        except Exception as e:
-            logger.error(f'Self-ping failed: {e}')
-        
-        time.sleep(300)
+            return await super().do_request(*args, **kwargs)
+        finally:
+            record_phase('send', time.perf_counter() - started)
+
+def log_slow_request(name, update, elapsed, phases):
+    user = getattr(update, 'effective_user', None)
+    chat = getattr(update, 'effective_chat', None)
+    record = {
+        'handler': name,
+        'user_id': user.id if user else None,
+        'chat_id': chat.id if chat else None,
+        'total_ms': round(elapsed * 1000, 1),
+    }
+    for phase in ('upstream', 'db', 'send'):
+        record[f'{phase}_ms'] = round(phases.get(phase, 0.0) * 1000, 1)
+    record['render_ms'] = round(max(0.0, elapsed - sum(phases.values())) * 1000, 1)
+    logger.warning(f'Slow request: {json.dumps(record)}')
+
+def instrument(name, callback):
+    """Wrap a handler callback with metrics, per-phase timing, slow request logging and /profile accounting"""
+    @wraps(callback)
+    async def wrapper(update, context):
+        HANDLER_CALLS.labels(name).inc()
+        HANDLERS_IN_FLIGHT.labels(name).inc()
+        phases = {}
+        phases_token = _request_phases.set(phases)
+        started = time.perf_counter()
+        try:
+            if not bot_ready.is_set() and name not in NO_WARM_UP_HANDLERS:
+                await reply_warming_up(update)
+                return
+            return await callback(update, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            _request_phases.reset(phases_token)
+            if 'send' in phases:
+                note_reply_sent()
+            HANDLER_DURATION.labels(name).observe(elapsed)
+            HANDLERS_IN_FLIGHT.labels(name).dec()
+            if elapsed * 1000 >= SLOW_REQUEST_MS:
+                log_slow_request(name, update, elapsed, phases)
+            if _profile_session is not None and name != 'profile':
+                await finish_profiled_update(context)
+    return wrapper
+
+async def on_startup(application):
+    # The web server shares the bot's event loop instead of running in its own thread
+    await start_webserver(application)
+    background_tasks.append(asyncio.create_task(warm_up()))
+    background_tasks.append(asyncio.create_task(self_ping()))
+    record_startup_milestone('accepting_updates')
+
+async def on_shutdown(application):
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    await stop_webserver()
+    stop_analytics_writer()
+    close_db_pool()
+
+async def run_webhook(application):
+    """Receive updates through the aiohttp server instead of long polling"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    async with application:
+        await on_startup(application)
+        try:
+            await application.start()
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=get_webhook_secret(application.bot.token),
+                allowed_updates=Update.ALL_TYPES
+            )
+            logger.info(f'Webhook set to {WEBHOOK_URL.rstrip("/")}{WEBHOOK_PATH}')
+            await stop_event.wait()
+            # The webhook is left in place for the other instances behind the load balancer
+            await application.stop()
+        finally:
+            await on_shutdown(application)
 
 def main():
-    global yandex_client
-    
     token = os.getenv('TELEGRAM_BOT_TOKEN')
     
     if not token:
@@ -1080,53 +2740,58 @@ def main():
         print('Пожалуйста, добавьте токен бота в переменные окружения.')
         return
     
-    yandex_token = os.getenv('YANDEX_MUSIC_TOKEN')
-    
-    if yandex_token:
-        try:
-            yandex_client = Client(yandex_token).init()
-            logger.info('Яндекс.Музыка подключена успешно!')
-            print('✅ Яндекс.Музыка подключена!')
-        except Exception as e:
-            logger.error(f'Ошибка подключения к Яндекс.Музыке: {e}')
-            print(f'⚠️ Не удалось подключиться к Яндекс.Музыке: {e}')
-    else:
+    if not os.getenv('YANDEX_MUSIC_TOKEN'):
         logger.warning('YANDEX_MUSIC_TOKEN not found')
         print('⚠️ YANDEX_MUSIC_TOKEN не найден')
     
-    webserver_thread = threading.Thread(target=run_webserver, daemon=True)
-    webserver_thread.start()
-    
-    ping_thread = threading.Thread(target=self_ping, daemon=True)
-    ping_thread.start()
-    
-    # Initialize database tables
-    init_db()
-    
-    # Log bot startup to database
-    log_bot_startup()
-    
-    application = Application.builder().token(token).build()
-    
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("search", search_music))
-    application.add_handler(CommandHandler("admin_stats", admin_stats))
-    application.add_handler(CommandHandler("bot_uptime", bot_uptime))
-    application.add_handler(CommandHandler("user_actions", user_actions_cmd))
-    application.add_handler(CommandHandler("list_users", list_users_cmd))
-    application.add_handler(CommandHandler("add_admin", add_admin_cmd))
-    application.add_handler(CommandHandler("remove_admin", remove_admin_cmd))
-    application.add_handler(CommandHandler("my_stats", my_stats))
-    application.add_handler(MessageHandler(filters.COMMAND, unknown_command))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    # Database and Yandex Music are initialized in the background by on_startup()
+    builder = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(ChatOrderedUpdateProcessor(UPDATE_WORKERS))
+        # Same pool size the builder uses by default, so concurrent replies do not queue
+        .request(TimedRequest(connection_pool_size=256))
+    )
+    if WEBHOOK_URL:
+        # Updates arrive through the webhook route, so no Updater is needed
+        application = builder.updater(None).build()
+    else:
+        application = builder.post_init(on_startup).post_shutdown(on_shutdown).build()
+    
+    application.add_handler(CommandHandler("start", instrument("start", start)))
+    application.add_handler(CommandHandler("help", instrument("help", help_command)))
+    application.add_handler(CommandHandler("search", instrument("search", search_music)))
+    application.add_handler(CallbackQueryHandler(instrument("search_page", search_results_page), pattern=r'^res:'))
+    application.add_handler(CommandHandler("admin_stats", instrument("admin_stats", admin_stats)))
+    application.add_handler(CommandHandler("backfill_stats", instrument("backfill_stats", backfill_stats_cmd)))
+    application.add_handler(CommandHandler("bot_uptime", instrument("bot_uptime", bot_uptime)))
+    application.add_handler(CommandHandler("user_actions", instrument("user_actions", user_actions_cmd)))
+    application.add_handler(CommandHandler("list_users", instrument("list_users", list_users_cmd)))
+    application.add_handler(CallbackQueryHandler(instrument("list_users_page", list_users_page), pattern=r'^users:'))
+    application.add_handler(CommandHandler("add_admin", instrument("add_admin", add_admin_cmd)))
+    application.add_handler(CommandHandler("remove_admin", instrument("remove_admin", remove_admin_cmd)))
+    application.add_handler(CommandHandler("my_stats", instrument("my_stats", my_stats)))
+    application.add_handler(CommandHandler("profile", instrument("profile", profile_cmd)))
+    application.add_handler(InlineQueryHandler(instrument("inline_search", inline_search)))
+    application.add_handler(MessageHandler(filters.COMMAND, instrument("unknown_command", unknown_command)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrument("text_search", handle_text)))
     
     application.add_error_handler(error_handler)
     
     logger.info('Бот запущен!')
     print('🤖 Бот успешно запущен и готов к работе!')
     
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        print('🪝 Режим webhook')
+        asyncio.run(run_webhook(application))
+    else:
+        # Polling remains the fallback when no public URL is configured
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate':
+        migrated = init_db()
+        close_db_pool()
+        sys.exit(0 if migrated else 1)
+    else:
+        main()
@@ -1,4 +1,6 @@
--- Create users table
+-- Base schema. Uses IF NOT EXISTS so databases created by older versions
+-- of the bot (or by init_db.sql) are adopted without changes.
+
 CREATE TABLE IF NOT EXISTS users (
     user_id BIGINT PRIMARY KEY,
     username VARCHAR(255),
@@ -9,7 +11,6 @@ CREATE TABLE IF NOT EXISTS users (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
--- Create searches table
 CREATE TABLE IF NOT EXISTS searches (
     id SERIAL PRIMARY KEY,
     user_id BIGINT REFERENCES users(user_id),
@@ -18,7 +19,6 @@ CREATE TABLE IF NOT EXISTS searches (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
--- Create track_views table
 CREATE TABLE IF NOT EXISTS track_views (
     id SERIAL PRIMARY KEY,
     user_id BIGINT REFERENCES users(user_id),
@@ -28,7 +28,6 @@ CREATE TABLE IF NOT EXISTS track_views (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
--- Create user_actions table
 CREATE TABLE IF NOT EXISTS user_actions (
     id SERIAL PRIMARY KEY,
     user_id BIGINT REFERENCES users(user_id),
@@ -37,7 +36,6 @@ CREATE TABLE IF NOT EXISTS user_actions (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
--- Create admins table
 CREATE TABLE IF NOT EXISTS admins (
     id SERIAL PRIMARY KEY,
     user_id BIGINT REFERENCES users(user_id),
@@ -45,13 +43,11 @@ CREATE TABLE IF NOT EXISTS admins (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
--- Create bot_sessions table
 CREATE TABLE IF NOT EXISTS bot_sessions (
     id SERIAL PRIMARY KEY,
     started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
--- Create indexes for faster queries
 CREATE INDEX IF NOT EXISTS idx_searches_user_id ON searches(user_id);
 CREATE INDEX IF NOT EXISTS idx_track_views_user_id ON track_views(user_id);
 CREATE INDEX IF NOT EXISTS idx_user_actions_user_id ON user_actions(user_id);
@@ -0,0 +1,21 @@
+-- Rollup tables for /admin_stats, maintained by the analytics writer.
+-- Run /backfill_stats once to fill them from existing history.
+
+CREATE TABLE IF NOT EXISTS stats_daily (
+    day DATE PRIMARY KEY,
+    searches BIGINT NOT NULL DEFAULT 0,
+    track_views BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS query_stats (
+    query TEXT PRIMARY KEY,
+    searches BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS artist_stats (
+    artist TEXT PRIMARY KEY,
+    views BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS idx_query_stats_searches ON query_stats(searches DESC);
+CREATE INDEX IF NOT EXISTS idx_artist_stats_views ON artist_stats(views DESC);
@@ -0,0 +1,22 @@
+-- migrate: no-transaction
+-- Composite indexes for the queries that filter or sort on more than user_id.
+-- Built CONCURRENTLY so writes keep going on large tables. If a build fails,
+-- drop the INVALID index it leaves behind and restart the bot.
+
+-- /admin_stats top users and /list_users ordering
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_total_uses ON users(total_uses DESC, user_id DESC);
+
+-- get_user_id_by_username
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_username ON users(username);
+
+-- Last search per user and /my_stats
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_searches_user_created ON searches(user_id, created_at DESC);
+
+-- Per-query lookups on the raw search log
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_searches_query ON searches(query);
+
+-- /user_actions history and last interaction in /admin_stats
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_user_actions_user_created ON user_actions(user_id, created_at DESC);
+
+-- /bot_uptime
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_bot_sessions_started_at ON bot_sessions(started_at DESC);
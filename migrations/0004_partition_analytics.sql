@@ -0,0 +1,98 @@
+-- Monthly range partitioning on created_at for the append-only analytics tables.
+-- Existing rows are copied into the new partitioned tables and ids keep their
+-- sequences. Upcoming months are created ahead of time by the bot's partition
+-- maintenance. There is deliberately no default partition: it would stop the
+-- planner from reading partitions newest-first for ORDER BY created_at DESC LIMIT.
+
+-- Creates <parent>_pYYYY_MM for the month containing for_month
+CREATE OR REPLACE FUNCTION ensure_monthly_partition(parent TEXT, for_month DATE) RETURNS BOOLEAN AS $$
+DECLARE
+    month_start DATE := date_trunc('month', for_month)::date;
+    month_end DATE := (date_trunc('month', for_month) + INTERVAL '1 month')::date;
+    part_name TEXT := format('%s_p%s', parent, to_char(date_trunc('month', for_month), 'YYYY_MM'));
+BEGIN
+    IF to_regclass(part_name) IS NOT NULL THEN
+        RETURN FALSE;
+    END IF;
+    EXECUTE format(
+        'CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+        part_name, parent, month_start, month_end
+    );
+    RETURN TRUE;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    parent TEXT;
+BEGIN
+    FOREACH parent IN ARRAY ARRAY['searches', 'track_views', 'user_actions'] LOOP
+        EXECUTE format('ALTER TABLE %I RENAME TO %I', parent, parent || '_legacy');
+        EXECUTE format('ALTER TABLE %I RENAME CONSTRAINT %I TO %I',
+                       parent || '_legacy', parent || '_pkey', parent || '_legacy_pkey');
+    END LOOP;
+END $$;
+
+CREATE TABLE searches (
+    id INT NOT NULL DEFAULT nextval('searches_id_seq'),
+    user_id BIGINT REFERENCES users(user_id),
+    query TEXT,
+    results_count INT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE track_views (
+    id INT NOT NULL DEFAULT nextval('track_views_id_seq'),
+    user_id BIGINT REFERENCES users(user_id),
+    track_title TEXT,
+    track_artists TEXT,
+    query TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE user_actions (
+    id INT NOT NULL DEFAULT nextval('user_actions_id_seq'),
+    user_id BIGINT REFERENCES users(user_id),
+    action_type VARCHAR(255),
+    action_details TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+DO $$
+DECLARE
+    parent TEXT;
+    first_month DATE;
+    cur_month DATE;
+    undated_rows BIGINT;
+BEGIN
+    FOREACH parent IN ARRAY ARRAY['searches', 'track_views', 'user_actions'] LOOP
+        -- Rows without a timestamp are parked in the epoch month, the first one retention archives
+        EXECUTE format('UPDATE %I SET created_at = %L WHERE created_at IS NULL',
+                       parent || '_legacy', 'epoch'::timestamp);
+        GET DIAGNOSTICS undated_rows = ROW_COUNT;
+        IF undated_rows > 0 THEN
+            PERFORM ensure_monthly_partition(parent, 'epoch'::date);
+        END IF;
+        EXECUTE format('SELECT min(created_at) FROM %I WHERE created_at > %L',
+                       parent || '_legacy', 'epoch'::timestamp) INTO first_month;
+
+        cur_month := date_trunc('month', COALESCE(first_month, CURRENT_DATE))::date;
+        WHILE cur_month <= date_trunc('month', CURRENT_DATE + INTERVAL '3 months') LOOP
+            PERFORM ensure_monthly_partition(parent, cur_month);
+            cur_month := (cur_month + INTERVAL '1 month')::date;
+        END LOOP;
+
+        EXECUTE format('INSERT INTO %I SELECT * FROM %I', parent, parent || '_legacy');
+        EXECUTE format('ALTER SEQUENCE %I OWNED BY %I.id', parent || '_id_seq', parent);
+        EXECUTE format('DROP TABLE %I', parent || '_legacy');
+    END LOOP;
+END $$;
+
+-- Indexes on the parents cascade to every partition, including future ones
+CREATE INDEX idx_searches_user_created ON searches(user_id, created_at DESC);
+CREATE INDEX idx_searches_query ON searches(query);
+CREATE INDEX idx_track_views_user_id ON track_views(user_id);
+CREATE INDEX idx_user_actions_user_created ON user_actions(user_id, created_at DESC);
@@ -0,0 +1,13 @@
+-- Second-level search cache shared by all instances and kept across restarts.
+-- payload is one upstream results page as zlib-compressed JSON. UNLOGGED: the
+-- contents are disposable, so writes skip the WAL. Expired rows are purged by the bot.
+
+CREATE UNLOGGED TABLE IF NOT EXISTS search_cache (
+    query TEXT NOT NULL,
+    page INT NOT NULL,
+    payload BYTEA NOT NULL,
+    expires_at TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (query, page)
+);
+
+CREATE INDEX IF NOT EXISTS idx_search_cache_expires_at ON search_cache(expires_at);
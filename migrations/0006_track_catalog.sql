@@ -0,0 +1,40 @@
+-- Track catalog keyed by Yandex Music ids. track_views now references tracks
+-- instead of repeating title and artist strings on every row, and artist stats
+-- are counted per artist id, so every artist of a multi-artist track is credited.
+-- Rows written before this migration keep their text columns and no track_id;
+-- they still count in daily totals but are not attributed to artists.
+
+CREATE TABLE IF NOT EXISTS artists (
+    id BIGINT PRIMARY KEY,
+    name TEXT NOT NULL
+);
+
+-- Yandex track ids are not always numeric, so the catalog has its own key
+CREATE TABLE IF NOT EXISTS tracks (
+    id SERIAL PRIMARY KEY,
+    yandex_id TEXT NOT NULL UNIQUE,
+    album_id BIGINT,
+    title TEXT NOT NULL,
+    duration_ms INT
+);
+
+CREATE TABLE IF NOT EXISTS track_artists (
+    track_id INT NOT NULL REFERENCES tracks(id),
+    artist_id BIGINT NOT NULL REFERENCES artists(id),
+    position SMALLINT NOT NULL,
+    PRIMARY KEY (track_id, artist_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_track_artists_artist_id ON track_artists(artist_id);
+
+ALTER TABLE track_views ADD COLUMN IF NOT EXISTS track_id INT REFERENCES tracks(id);
+
+-- The old rollup grouped on joined artist strings; run /backfill_stats to refill it by id
+DROP TABLE IF EXISTS artist_stats;
+
+CREATE TABLE artist_stats (
+    artist_id BIGINT PRIMARY KEY REFERENCES artists(id),
+    views BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS idx_artist_stats_views ON artist_stats(views DESC);
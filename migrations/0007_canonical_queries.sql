@@ -0,0 +1,36 @@
+-- Canonical query ids. searches and track_views reference queries by a signed
+-- 64-bit hash of the canonical query text (see canonical_query() in main.py),
+-- and the text itself is stored once. Run /backfill_stats to fill query_id on
+-- older rows and to rebuild query_stats, which is now keyed by query_id.
+
+CREATE TABLE IF NOT EXISTS queries (
+    id BIGINT PRIMARY KEY,
+    canonical TEXT NOT NULL
+);
+
+ALTER TABLE searches ADD COLUMN IF NOT EXISTS query_id BIGINT REFERENCES queries(id);
+ALTER TABLE track_views ADD COLUMN IF NOT EXISTS query_id BIGINT REFERENCES queries(id);
+
+CREATE INDEX IF NOT EXISTS idx_searches_query_id ON searches(query_id);
+
+DROP TABLE IF EXISTS query_stats;
+
+CREATE TABLE query_stats (
+    query_id BIGINT PRIMARY KEY REFERENCES queries(id),
+    searches BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS idx_query_stats_searches ON query_stats(searches DESC);
+
+-- Cached pages are keyed by query id too; the old entries are disposable
+DROP TABLE IF EXISTS search_cache;
+
+CREATE UNLOGGED TABLE search_cache (
+    query_id BIGINT NOT NULL,
+    page INT NOT NULL,
+    payload BYTEA NOT NULL,
+    expires_at TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (query_id, page)
+);
+
+CREATE INDEX IF NOT EXISTS idx_search_cache_expires_at ON search_cache(expires_at);
@@ -0,0 +1,85 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+LATENCY = 0.2
+
+
+class FakeYandexClient:
+    """Stands in for ClientAsync: every search sleeps for the given latency"""
+
+    def __init__(self, latency=LATENCY):
+        self.latency = latency
+        self.calls = 0
+
+    async def search(self, text, type_='track', page=0):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        track = SimpleNamespace(
+            id=f'{text}:{page}',
+            albums=[SimpleNamespace(id=1)],
+            title=text,
+            artists=[SimpleNamespace(id=1, name='Artist')],
+            duration_ms=180000
+        )
+        return SimpleNamespace(tracks=SimpleNamespace(results=[track], total=1))
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    client = FakeYandexClient()
+    monkeypatch.setattr(main, 'yandex_client', client)
+    monkeypatch.setattr(main, 'search_cache', main.TTLCache(60, 1000, 1024 * 1024))
+    monkeypatch.setattr(main, 'upstream_semaphore', asyncio.Semaphore(main.UPSTREAM_CONCURRENCY))
+    return client
+
+
+def test_concurrent_searches_overlap(fake_client):
+    searches = main.UPSTREAM_CONCURRENCY
+
+    async def run():
+        started = time.perf_counter()
+        results = await asyncio.gather(*(main.search_tracks(f'query {n}') for n in range(searches)))
+        return results, time.perf_counter() - started
+
+    results, elapsed = asyncio.run(run())
+
+    assert fake_client.calls == searches
+    assert [result['tracks'][0]['title'] for result in results] == [f'query {n}' for n in range(searches)]
+    assert elapsed < LATENCY * 2
+
+
+def test_identical_searches_share_one_upstream_call(fake_client):
+    async def run():
+        return await asyncio.gather(*(main.search_tracks('Same Query') for _ in range(20)))
+
+    results = asyncio.run(run())
+
+    assert fake_client.calls == 1
+    assert all(result == results[0] for result in results)
+    assert main._inflight_searches == {}
+
+
+def test_upstream_failure_reaches_every_waiter(fake_client):
+    async def failing_search(text, type_='track', page=0):
+        fake_client.calls += 1
+        await asyncio.sleep(LATENCY)
+        raise ConnectionError('upstream down')
+
+    fake_client.search = failing_search
+
+    async def run():
+        return await asyncio.gather(
+            *(main.search_tracks('Failing Query') for _ in range(20)),
+            return_exceptions=True
+        )
+
+    results = asyncio.run(run())
+
+    assert fake_client.calls == 1
+    assert all(isinstance(result, ConnectionError) for result in results)
+    assert main._inflight_searches == {}